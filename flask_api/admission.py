@@ -0,0 +1,111 @@
+import threading
+
+from PIL import Image
+
+# Rough peak working set of segment_leg per input pixel: the BGR, RGB and HSV
+# copies, the skin and flood-fill masks and the float intermediates
+SEGMENTATION_BYTES_PER_PIXEL = 40
+# Peak while decoding an oversized image: the decoded image, its RGB
+# conversion and the downscaled copy
+DECODE_BYTES_PER_PIXEL = 8
+
+class OverCapacity(Exception):
+    """Admitting the image would exceed the in-flight pixel capacity"""
+
+def read_image_size(stream):
+    """
+    Width, height and format from the image header, without decoding pixel data.
+
+    PIL's Image.open is lazy: it only parses the header. The stream is rewound
+    so it can be read again.
+    """
+    position = stream.tell()
+    try:
+        with Image.open(stream) as image:
+            return image.size, image.format
+    finally:
+        stream.seek(position)
+
+def decode_within_budget(stream, max_pixels):
+    """
+    Decode an image so it has at most max_pixels pixels.
+
+    JPEGs are decoded directly at a reduced scale (Image.draft); other formats
+    are decoded and then resized.
+    """
+    image = Image.open(stream)
+    width, height = image.size
+    scale = (max_pixels / (width * height)) ** 0.5
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+    image.draft('RGB', target)
+    image = image.convert('RGB')
+    if image.width * image.height > max_pixels:
+        image = image.resize(target, Image.BILINEAR)
+    return image
+
+class PixelBudget:
+    """
+    Admission control by pixel count.
+
+    Every request reserves the pixel count of its image for as long as it is
+    being processed. An image that is downscaled also reserves its full header
+    pixel count while it is decoded (decode_pixels), since formats other than
+    JPEG are decoded at full size before resizing; finish_decode() hands that
+    reservation back. A request that would push the total over capacity is
+    shed (OverCapacity), except when nothing else is in flight, so a single
+    image within the per-image limit is always admitted.
+    """
+    def __init__(self, capacity_pixels):
+        self.capacity_pixels = capacity_pixels
+        self.lock = threading.Lock()
+        self.in_flight_pixels = 0
+        self.decoding_pixels = 0
+        self.in_flight_requests = 0
+        self.counters = {
+            "admitted": 0,
+            "downscaled": 0,
+            "rejected_too_large": 0,
+            "rejected_invalid": 0,
+            "shed_over_capacity": 0,
+            "peak_in_flight_pixels": 0,
+            "peak_in_flight_requests": 0
+        }
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def acquire(self, pixels, decode_pixels=0):
+        with self.lock:
+            total = self.in_flight_pixels + self.decoding_pixels + pixels + decode_pixels
+            if self.in_flight_requests and total > self.capacity_pixels:
+                self.counters["shed_over_capacity"] += 1
+                raise OverCapacity(f"{total} pixels in flight, capacity {self.capacity_pixels}")
+            self.in_flight_pixels += pixels
+            self.decoding_pixels += decode_pixels
+            self.in_flight_requests += 1
+            self.counters["admitted"] += 1
+            self.counters["peak_in_flight_pixels"] = max(self.counters["peak_in_flight_pixels"], total)
+            self.counters["peak_in_flight_requests"] = max(self.counters["peak_in_flight_requests"],
+                                                           self.in_flight_requests)
+
+    def finish_decode(self, decode_pixels):
+        with self.lock:
+            self.decoding_pixels -= decode_pixels
+
+    def release(self, pixels, decode_pixels=0):
+        with self.lock:
+            self.in_flight_pixels -= pixels
+            self.decoding_pixels -= decode_pixels
+            self.in_flight_requests -= 1
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = dict(self.counters)
+            snapshot["in_flight_pixels"] = self.in_flight_pixels
+            snapshot["decoding_pixels"] = self.decoding_pixels
+            snapshot["in_flight_requests"] = self.in_flight_requests
+        snapshot["capacity_pixels"] = self.capacity_pixels
+        snapshot["estimated_in_flight_bytes"] = (snapshot["in_flight_pixels"] * SEGMENTATION_BYTES_PER_PIXEL
+                                                 + snapshot["decoding_pixels"] * DECODE_BYTES_PER_PIXEL)
+        return snapshot
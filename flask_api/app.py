@@ -1,14 +1,24 @@
 import torch
-import torch.nn as nn
-from torchvision import models, transforms
+from torchvision import transforms
+import torchvision.transforms.functional as TF
 from PIL import Image
 import os
 import numpy as np
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
+import hmac
 import io
 import sys
+import threading
+import time
+import json
+import logging
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from models.segment_leg import segment_leg
+from models.architecture import load_checkpoint
+from flask_api.admission import PixelBudget, OverCapacity, read_image_size, decode_within_budget
+from flask_api.profiler import ProfileSession
+from flask_api.debug_render import DebugRenderer
+from flask_api.hot_reload import ModelSlot, ShadowScorer
 
 app = Flask(__name__)
 
@@ -18,40 +28,366 @@ CLASS_NAMES = ['normal', 'moderate', 'severe'] # As per visualize.py
 DEVICE = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
 print(f"Using device: {DEVICE}")
 
-# Global model variable
-model_ft = None
+# Test-time augmentation: 'off', 'adaptive' (only when the plain prediction is
+# uncertain) or 'always'. Can be overridden per request with the `tta` form field.
+TTA_MODE = 'adaptive'
+TTA_MARGIN_THRESHOLD = 0.2 # Run TTA when top-1 minus top-2 probability is below this
+TTA_MODES = ('off', 'adaptive', 'always')
+
+# Two-stage cascade: a small stage-1 model answers confident cases and only
+# escalates the rest to the full model. Written by models/cascade.py; the
+# cascade is disabled if the file does not exist.
+CASCADE_CONFIG_PATH = 'models/checkpoints/cascade.json'
+
+# Admission control. Image dimensions are read from the header before anything
+# is decoded. Images above MAX_IMAGE_PIXELS are downscaled ('downscale') or
+# rejected with 413 ('reject'); images above MAX_DECODE_PIXELS are always
+# rejected. A request is shed with 503 when the images being processed would
+# exceed MAX_INFLIGHT_PIXELS in total.
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+MAX_IMAGE_PIXELS = 12_000_000
+MAX_DECODE_PIXELS = 64_000_000
+OVERSIZE_POLICY = 'downscale'
+MAX_INFLIGHT_PIXELS = 48_000_000
+RETRY_AFTER_SECONDS = 2
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+Image.MAX_IMAGE_PIXELS = MAX_DECODE_PIXELS # PIL's own decompression bomb guard
+pixel_budget = PixelBudget(MAX_INFLIGHT_PIXELS)
+
+# Admin endpoints are disabled unless a token is set in the environment
+ADMIN_TOKEN = os.environ.get('CVI_ADMIN_TOKEN')
+PROFILE_MAX_SECONDS = 60
+# Functions whose stacks are kept by the sampling profiler
+PROFILE_FRAME_FILTER = ('predict', 'segment_leg', 'run_inference')
+
+# Running profile session, None when not profiling
+active_profile = None
+profile_lock = threading.Lock()
+
+# Segmentation debug visualizations (see segment_leg.render_debug_artifacts) for a
+# sampled fraction of requests, rendered on a background thread after the
+# response is sent. 0 disables them.
+DEBUG_RENDER_SAMPLE_RATE = 0.0
+DEBUG_RENDER_DIR = 'debug_renders'
+DEBUG_RENDER_MAX_SIDE = 1024 # Intermediates are downscaled to this before queueing
+DEBUG_RENDER_QUEUE_BYTES = 64 * 1024 * 1024
+debug_renderer = DebugRenderer(DEBUG_RENDER_DIR, DEBUG_RENDER_SAMPLE_RATE, DEBUG_RENDER_QUEUE_BYTES,
+                               DEBUG_RENDER_MAX_SIDE)
+
+# Hot reload. HOT_RELOAD_WATCH_PATH is polled every HOT_RELOAD_POLL_SECONDS (0
+# disables the watcher). A changed checkpoint is loaded and warmed up next to the
+# serving model, then swapped in ('swap') or first scored in shadow on
+# SHADOW_SAMPLE_RATE of the requests ('shadow'). /admin/reload does the same on demand.
+# The watched path is a deploy location, not MODEL_CHECKPOINT_PATH, which training
+# overwrites on every improving epoch; copy the descriptor there before the weights.
+HOT_RELOAD_WATCH_PATH = 'models/deploy/model.pth'
+HOT_RELOAD_POLL_SECONDS = 0
+HOT_RELOAD_MODE = 'swap'
+HOT_RELOAD_MODES = ('swap', 'shadow')
+SHADOW_SAMPLE_RATE = 0.1
+SHADOW_MAX_PENDING = 4
+
+# Counters reported by /stats
+stats_lock = threading.Lock()
+inference_stats = {
+    "requests": 0,
+    "tta_triggered": 0,
+    "inference_ms_total": 0.0,
+    "tta_ms_total": 0.0,
+    "cascade_requests": 0,
+    "cascade_escalations": 0,
+    "stage1_ms_total": 0.0,
+    "stage2_ms_total": 0.0
+}
+
+# Global model variables
+stage1_model = None
+cascade_config = None
+
+def make_transform(input_size):
+    """Inference transform (should match the validation transforms from training)"""
+    return transforms.Compose([
+        transforms.Resize((input_size, input_size)),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+def disable_stale_cascade(previous, version):
+    """The cascade threshold was calibrated against the previous full model"""
+    global stage1_model
+    if stage1_model is None:
+        return
+    stage1_model = None
+    app.logger.warning(f"Cascade disabled: its threshold was calibrated for {cascade_config.get('full_checkpoint')}, "
+                       f"not model version {version.version}. Re-run models/cascade.py and restart the API.")
+
+# The serving model (replaced on hot reload) and the candidate scored in shadow
+model_slot = ModelSlot(DEVICE, make_transform, on_swap=disable_stale_cascade)
+shadow_scorer = ShadowScorer(DEVICE, SHADOW_SAMPLE_RATE, SHADOW_MAX_PENDING)
 
 def load_model():
-    global model_ft
-    model_ft = models.mobilenet_v2(pretrained=False) # Or True if you used a pretrained base
-    model_ft.classifier[1] = nn.Linear(model_ft.last_channel, len(CLASS_NAMES))
-    
     if os.path.exists(MODEL_CHECKPOINT_PATH):
         try:
-            # Load checkpoint compatible with the device
-            model_ft.load_state_dict(torch.load(MODEL_CHECKPOINT_PATH, map_location=DEVICE))
-            print(f"Loaded model checkpoint from {MODEL_CHECKPOINT_PATH}")
+            # Load checkpoint compatible with the device, using the architecture
+            # descriptor next to it (stock MobileNetV2 if there is none)
+            version = model_slot.reload(MODEL_CHECKPOINT_PATH)
+            print(f"Loaded model checkpoint from {MODEL_CHECKPOINT_PATH} (version {version.version})")
         except Exception as e:
             print(f"Error loading model checkpoint: {e}")
-            model_ft = None # Ensure model is None if loading fails
     else:
         print(f"Error: Checkpoint not found at {MODEL_CHECKPOINT_PATH}")
-        model_ft = None
     
-    if model_ft:
-        model_ft = model_ft.to(DEVICE)
-        model_ft.eval() # Set model to evaluation mode
+    load_cascade()
+
+def load_cascade():
+    global stage1_model, stage1_transform, cascade_config
+    stage1_model = None
+    cascade_config = None
+    
+    if not os.path.exists(CASCADE_CONFIG_PATH):
+        return
+    
+    try:
+        with open(CASCADE_CONFIG_PATH) as f:
+            config = json.load(f)
+        stage1_model, descriptor = load_checkpoint(config['stage1_checkpoint'], DEVICE)
+        stage1_transform = make_transform(descriptor['input_size'])
+        cascade_config = config
+        print(f"Loaded cascade stage 1 from {config['stage1_checkpoint']} "
+              f"(threshold {config['threshold']:.4f})")
+    except Exception as e:
+        print(f"Error loading cascade, using the full model only: {e}")
+        stage1_model = None
 
-# Data transforms (should match the validation transforms from training)
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-])
+stage1_transform = None
+
+def tta_views(image):
+    """Augmented copies of a PIL image used for test-time augmentation"""
+    w, h = image.size
+    crop_size = [int(h * 0.9), int(w * 0.9)]
+    flipped = TF.hflip(image)
+    return [
+        flipped,
+        TF.rotate(image, 10),
+        TF.rotate(image, -10),
+        TF.center_crop(image, crop_size),
+        TF.center_crop(flipped, crop_size)
+    ]
+
+def softmax_margin(probs):
+    """Difference between the two highest class probabilities"""
+    top2 = np.sort(probs)[-2:]
+    return float(top2[1] - top2[0])
+
+def classify_full(image, tta_mode, active):
+    """
+    Classify a PIL image with the full model version `active`, adding test-time
+    augmentation when requested.
+    
+    In 'adaptive' mode the plain view runs first and the augmented views are only
+    evaluated, as one batched forward pass, if the softmax margin is below
+    TTA_MARGIN_THRESHOLD.
+    
+    Returns:
+        (probabilities as numpy array, dict describing the TTA decision)
+    """
+    input_tensor = active.transform(image).unsqueeze(0).to(DEVICE)
+    with torch.no_grad():
+        output = active.model(input_tensor)
+        probs_np = torch.nn.functional.softmax(output, dim=1)[0].cpu().numpy()
+    
+    margin = softmax_margin(probs_np)
+    triggered = tta_mode == 'always' or (tta_mode == 'adaptive' and margin < TTA_MARGIN_THRESHOLD)
+    tta_ms = 0.0
+    views = 1
+    
+    if triggered:
+        start = time.perf_counter()
+        batch = torch.stack([active.transform(view) for view in tta_views(image)]).to(DEVICE)
+        with torch.no_grad():
+            tta_probs = torch.nn.functional.softmax(active.model(batch), dim=1).cpu().numpy()
+        # Average the plain view together with the augmented ones
+        probs_np = (probs_np + tta_probs.sum(axis=0)) / (len(tta_probs) + 1)
+        views += len(tta_probs)
+        tta_ms = (time.perf_counter() - start) * 1000
+    
+    tta_info = {
+        "mode": tta_mode,
+        "triggered": triggered,
+        "margin": margin,
+        "views": views,
+        "latency_ms": tta_ms
+    }
+    return probs_np, tta_info
+
+def run_inference(image, tta_mode=TTA_MODE, use_cascade=True, active=None):
+    """
+    Classify a PIL image, first with the cascade's stage-1 model if one is loaded.
+    
+    Images whose stage-1 confidence is below the calibrated threshold escalate to
+    the full model (with adaptive TTA). `active` is the full model version to use,
+    the one currently served by default.
+    
+    Returns:
+        (probabilities as numpy array, TTA info dict, cascade info dict or None)
+    """
+    active = active or model_slot.current
+    start = time.perf_counter()
+    cascade_info = None
+    # Read once: a model swap disables the cascade from another thread
+    stage1 = stage1_model
+    
+    if use_cascade and stage1 is not None:
+        input_tensor = stage1_transform(image).unsqueeze(0).to(DEVICE)
+        with torch.no_grad():
+            probs_np = torch.nn.functional.softmax(stage1(input_tensor), dim=1)[0].cpu().numpy()
+        stage1_ms = (time.perf_counter() - start) * 1000
+        escalated = float(probs_np.max()) < cascade_config['threshold']
+        cascade_info = {
+            "stage": 2 if escalated else 1,
+            "escalated": escalated,
+            "stage1_confidence": float(probs_np.max()),
+            "stage1_ms": stage1_ms,
+            "stage2_ms": 0.0
+        }
+    
+    if cascade_info is None or cascade_info["escalated"]:
+        stage2_start = time.perf_counter()
+        probs_np, tta_info = classify_full(image, tta_mode, active)
+        if cascade_info is not None:
+            cascade_info["stage2_ms"] = (time.perf_counter() - stage2_start) * 1000
+    else:
+        tta_info = {"mode": tta_mode, "triggered": False, "margin": softmax_margin(probs_np),
+                    "views": 1, "latency_ms": 0.0}
+    
+    total_ms = (time.perf_counter() - start) * 1000
+    with stats_lock:
+        inference_stats["requests"] += 1
+        inference_stats["inference_ms_total"] += total_ms
+        if tta_info["triggered"]:
+            inference_stats["tta_triggered"] += 1
+            inference_stats["tta_ms_total"] += tta_info["latency_ms"]
+        if cascade_info is not None:
+            inference_stats["cascade_requests"] += 1
+            inference_stats["stage1_ms_total"] += cascade_info["stage1_ms"]
+            if cascade_info["escalated"]:
+                inference_stats["cascade_escalations"] += 1
+                inference_stats["stage2_ms_total"] += cascade_info["stage2_ms"]
+    
+    return probs_np, tta_info, cascade_info
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    with stats_lock:
+        snapshot = dict(inference_stats)
+    requests_seen = snapshot["requests"]
+    triggered = snapshot["tta_triggered"]
+    cascade_requests = snapshot["cascade_requests"]
+    escalations = snapshot["cascade_escalations"]
+    snapshot["tta_trigger_rate"] = triggered / requests_seen if requests_seen else 0.0
+    snapshot["mean_inference_ms"] = snapshot["inference_ms_total"] / requests_seen if requests_seen else 0.0
+    snapshot["mean_tta_ms_when_triggered"] = snapshot["tta_ms_total"] / triggered if triggered else 0.0
+    snapshot["cascade_enabled"] = stage1_model is not None
+    snapshot["cascade_escalation_rate"] = escalations / cascade_requests if cascade_requests else 0.0
+    snapshot["mean_stage1_ms"] = snapshot["stage1_ms_total"] / cascade_requests if cascade_requests else 0.0
+    snapshot["mean_stage2_ms_when_escalated"] = snapshot["stage2_ms_total"] / escalations if escalations else 0.0
+    snapshot["admission"] = pixel_budget.snapshot()
+    snapshot["debug_render"] = debug_renderer.snapshot()
+    snapshot["model"] = model_slot.describe()
+    snapshot["shadow"] = shadow_scorer.snapshot()
+    return jsonify(snapshot)
+
+def is_admin(req):
+    token = req.headers.get('X-Admin-Token', '')
+    return ADMIN_TOKEN is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+@app.route('/admin/profile', methods=['POST'])
+def admin_profile():
+    """
+    Profile live traffic for `seconds` (default 10) and return a zip with sampled
+    Python stacks, torch operator timings and the top allocations.
+    """
+    global active_profile
+    if not is_admin(request):
+        return jsonify({"error": "Forbidden"}), 403
+    
+    try:
+        seconds = float(request.args.get('seconds', 10))
+    except ValueError:
+        return jsonify({"error": "seconds must be a number"}), 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({"error": f"seconds must be between 0 and {PROFILE_MAX_SECONDS}"}), 400
+    
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({"error": "A profile is already running"}), 409
+    try:
+        session = ProfileSession(seconds, frame_filter=PROFILE_FRAME_FILTER)
+        active_profile = session
+        try:
+            artifact = session.run()
+        finally:
+            active_profile = None
+    finally:
+        profile_lock.release()
+    
+    return send_file(io.BytesIO(artifact), mimetype='application/zip', as_attachment=True,
+                     download_name=f"profile-{int(time.time())}.zip")
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """
+    Load a checkpoint (default MODEL_CHECKPOINT_PATH) next to the serving model
+    and either swap it in (mode=swap) or score it in shadow (mode=shadow).
+    """
+    if not is_admin(request):
+        return jsonify({"error": "Forbidden"}), 403
+    
+    checkpoint = request.form.get('checkpoint', MODEL_CHECKPOINT_PATH)
+    mode = request.form.get('mode', HOT_RELOAD_MODE)
+    if mode not in HOT_RELOAD_MODES:
+        return jsonify({"error": f"Invalid mode '{mode}', expected one of {list(HOT_RELOAD_MODES)}"}), 400
+    if not os.path.exists(checkpoint):
+        return jsonify({"error": f"Checkpoint not found at {checkpoint}"}), 404
+    
+    try:
+        if mode == 'swap':
+            model_slot.reload(checkpoint)
+        else:
+            shadow_scorer.set_candidate(model_slot.load(checkpoint))
+    except Exception as e:
+        app.logger.error(f"Error reloading {checkpoint}: {e}", exc_info=True)
+        return jsonify({"error": "Error loading checkpoint", "details": str(e)}), 500
+    
+    return jsonify({"model": model_slot.describe(), "shadow": shadow_scorer.snapshot()})
+
+@app.route('/admin/promote', methods=['POST'])
+def admin_promote():
+    """Serve the shadow candidate, or drop it with action=discard"""
+    if not is_admin(request):
+        return jsonify({"error": "Forbidden"}), 403
+    
+    candidate = shadow_scorer.candidate
+    if candidate is None:
+        return jsonify({"error": "No shadow candidate loaded"}), 409
+    
+    shadow = shadow_scorer.snapshot()
+    shadow_scorer.set_candidate(None)
+    if request.form.get('action', 'promote') != 'discard':
+        # Serialized with the watcher and /admin/reload
+        with model_slot.reload_lock:
+            model_slot.swap(candidate)
+    return jsonify({"model": model_slot.describe(), "shadow": shadow})
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    pixel_budget.count("rejected_too_large")
+    return jsonify({"error": f"Upload exceeds {MAX_UPLOAD_BYTES} bytes"}), 413
 
 @app.route('/predict', methods=['POST'])
 def predict():
-    if model_ft is None:
+    active = model_slot.current
+    if active is None:
         return jsonify({"error": "Model not loaded. Check server logs."}), 500
 
     if 'file' not in request.files:
@@ -61,69 +397,135 @@ def predict():
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
 
-    if file:
-        try:
-            # Save the uploaded file temporarily
-            temp_dir = "temp_uploads"
-            os.makedirs(temp_dir, exist_ok=True)
-            temp_image_path = os.path.join(temp_dir, file.filename)
-            file.save(temp_image_path)
-
-            # --- Adapted predict_single_image logic ---
-            image_for_inference = None
-            segmented_image_path = os.path.join(temp_dir, f"{os.path.splitext(file.filename)[0]}_segmented.jpg")
+    tta_mode = request.form.get('tta', TTA_MODE)
+    if tta_mode not in TTA_MODES:
+        return jsonify({"error": f"Invalid tta mode '{tta_mode}', expected one of {list(TTA_MODES)}"}), 400
+    use_cascade = request.form.get('cascade', 'on') != 'off'
 
+    # Admission control on the header dimensions, before any pixel data is decoded
+    try:
+        (width, height), _ = read_image_size(file.stream)
+    except Image.DecompressionBombError as e:
+        pixel_budget.count("rejected_too_large")
+        return jsonify({"error": "Image too large", "details": str(e)}), 413
+    except Exception as e:
+        pixel_budget.count("rejected_invalid")
+        return jsonify({"error": "Unreadable image", "details": str(e)}), 400
+    
+    pixels = width * height
+    downscale = pixels > MAX_IMAGE_PIXELS
+    if downscale and (OVERSIZE_POLICY == 'reject' or pixels > MAX_DECODE_PIXELS):
+        pixel_budget.count("rejected_too_large")
+        return jsonify({"error": f"Image has {pixels} pixels, the limit is {MAX_IMAGE_PIXELS}"}), 413
+    
+    # A downscaled image is decoded at full size first (except JPEG), so it
+    # holds its full pixel count until the decode is done
+    admitted_pixels = min(pixels, MAX_IMAGE_PIXELS)
+    decoding_pixels = pixels if downscale else 0
+    try:
+        pixel_budget.acquire(admitted_pixels, decoding_pixels)
+    except OverCapacity:
+        response = jsonify({"error": "Server is over capacity, retry later"})
+        response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+        return response, 503
+    
+    try:
+        if file:
             try:
-                # segment_leg expects paths, so we use the saved temp_image_path
-                segmented_image_pil = segment_leg(temp_image_path, segmented_image_path, visualize_seeds=False)
-                if isinstance(segmented_image_pil, str): # If segment_leg returns a path
-                     image_for_inference = Image.open(segmented_image_pil).convert('RGB')
-                else: # If segment_leg returns a PIL image
-                     image_for_inference = segmented_image_pil.convert('RGB')
-                print(f"Segmented image processed.")
-            except Exception as e:
-                print(f"Segmentation failed: {e}. Using original image.")
-                image_for_inference = Image.open(temp_image_path).convert('RGB')
-            
-            # Preprocess the image
-            input_tensor = transform(image_for_inference).unsqueeze(0).to(DEVICE)
-            
-            # Run inference
-            with torch.no_grad():
-                output = model_ft(input_tensor)
-                probabilities = torch.nn.functional.softmax(output, dim=1)[0]
+                # Save the uploaded file temporarily
+                temp_dir = "temp_uploads"
+                os.makedirs(temp_dir, exist_ok=True)
+                if downscale:
+                    # Decode at reduced size and hand segment_leg a lossless copy
+                    temp_image_path = os.path.join(temp_dir, f"{os.path.splitext(file.filename)[0]}.png")
+                    decode_within_budget(file.stream, MAX_IMAGE_PIXELS).save(temp_image_path, compress_level=1)
+                    pixel_budget.finish_decode(decoding_pixels)
+                    decoding_pixels = 0
+                    pixel_budget.count("downscaled")
+                else:
+                    temp_image_path = os.path.join(temp_dir, file.filename)
+                    file.save(temp_image_path)
+
+                # --- Adapted predict_single_image logic ---
+                image_for_inference = None
+                segmented_image_path = os.path.join(temp_dir, f"{os.path.splitext(file.filename)[0]}_segmented.jpg")
+
+                render_debug = debug_renderer.should_sample()
+                segmentation_details = {}
+
+                try:
+                    # segment_leg expects paths, so we use the saved temp_image_path
+                    segmented_image_pil = segment_leg(temp_image_path, segmented_image_path, visualize_seeds=False,
+                                                      details=segmentation_details,
+                                                      collect_intermediates=render_debug)
+                    if isinstance(segmented_image_pil, str): # If segment_leg returns a path
+                         image_for_inference = Image.open(segmented_image_pil).convert('RGB')
+                    else: # If segment_leg returns a PIL image
+                         image_for_inference = segmented_image_pil.convert('RGB')
+                    print(f"Segmented image processed.")
+                except Exception as e:
+                    print(f"Segmentation failed: {e}. Using original image.")
+                    image_for_inference = Image.open(temp_image_path).convert('RGB')
             
-            probs_np = probabilities.cpu().numpy()
+                # Run inference (cascade stage 1 first, TTA if the full model is uncertain)
+                session = active_profile
+                if session is None:
+                    probs_np, tta_info, cascade_info = run_inference(image_for_inference, tta_mode, use_cascade, active)
+                else:
+                    with session.torch_profile():
+                        probs_np, tta_info, cascade_info = run_inference(image_for_inference, tta_mode,
+                                                                         use_cascade, active)
             
-            # Prepare response
-            response_data = {
-                "filename": file.filename,
-                "probabilities": {CLASS_NAMES[i]: float(probs_np[i]) for i in range(len(CLASS_NAMES))},
-                "predicted_class_index": int(np.argmax(probs_np)),
-                "predicted_class_name": CLASS_NAMES[np.argmax(probs_np)]
-            }
+                # Prepare response
+                response_data = {
+                    "filename": file.filename,
+                    "probabilities": {CLASS_NAMES[i]: float(probs_np[i]) for i in range(len(CLASS_NAMES))},
+                    "predicted_class_index": int(np.argmax(probs_np)),
+                    "predicted_class_name": CLASS_NAMES[np.argmax(probs_np)],
+                    "tta": tta_info,
+                    "cascade": cascade_info,
+                    "admission": {"pixels": pixels, "downscaled": downscale},
+                    "model_version": active.version
+                }
             
-            # Clean up temporary files
-            try:
-                os.remove(temp_image_path)
-                if os.path.exists(segmented_image_path):
-                    os.remove(segmented_image_path)
-            except OSError as e:
-                print(f"Error removing temporary files: {e}")
+                # Clean up temporary files
+                try:
+                    os.remove(temp_image_path)
+                    if os.path.exists(segmented_image_path):
+                        os.remove(segmented_image_path)
+                except OSError as e:
+                    print(f"Error removing temporary files: {e}")
 
-            return jsonify(response_data)
+                response = jsonify(response_data)
+                if render_debug and 'intermediates' in segmentation_details:
+                    # Queued once the response has been sent to the client
+                    response.call_on_close(lambda: debug_renderer.submit(
+                        file.filename, segmentation_details['intermediates'], image_for_inference))
+                if shadow_scorer.should_sample():
+                    # The candidate and the serving version run on a background thread after the response is sent
+                    response.call_on_close(lambda: shadow_scorer.submit(image_for_inference, active))
+                return response
 
-        except Exception as e:
-            # Log the full exception for debugging
-            app.logger.error(f"Error during prediction: {e}", exc_info=True)
-            return jsonify({"error": "Error processing image", "details": str(e)}), 500
+            except Exception as e:
+                # Log the full exception for debugging
+                app.logger.error(f"Error during prediction: {e}", exc_info=True)
+                return jsonify({"error": "Error processing image", "details": str(e)}), 500
             
-    return jsonify({"error": "File processing failed"}), 500
+        return jsonify({"error": "File processing failed"}), 500
+    finally:
+        pixel_budget.release(admitted_pixels, decoding_pixels)
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     load_model() # Load the model when the script starts
-    if model_ft is None:
+    debug_renderer.start()
+    if model_slot.current is None:
         print("Failed to load the model. API will not work correctly.")
+    if HOT_RELOAD_POLL_SECONDS:
+        # In shadow mode a changed checkpoint becomes the shadow candidate instead of being served
+        on_change = (lambda path: shadow_scorer.set_candidate(model_slot.load(path))) \
+            if HOT_RELOAD_MODE == 'shadow' else None
+        model_slot.watch(HOT_RELOAD_WATCH_PATH, HOT_RELOAD_POLL_SECONDS, on_change)
     # Make sure to create 'temp_uploads' directory if it doesn't exist
     os.makedirs("temp_uploads", exist_ok=True)
     app.run(debug=True, host='0.0.0.0', port=5001) 
\ No newline at end of file
@@ -0,0 +1,112 @@
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from models.segment_leg import render_debug_artifacts
+
+logger = logging.getLogger(__name__)
+
+def downscale_intermediates(intermediates, result, max_side):
+    """
+    Copies of segment_leg's intermediates and result whose longer side is at
+    most max_side, so a queued job holds a debug-resolution copy instead of the
+    full-resolution masks.
+    """
+    h, w = intermediates['image'].shape[:2]
+    scale = min(1.0, max_side / max(h, w))
+    size = (max(1, int(w * scale)), max(1, int(h * scale)))
+
+    small = {'seed_points': [(x * scale, y * scale) for x, y in intermediates.get('seed_points', [])]}
+    for name, value in intermediates.items():
+        if isinstance(value, np.ndarray):
+            # Area averaging for the photo, nearest neighbour keeps masks binary
+            interpolation = cv2.INTER_AREA if value.ndim == 3 else cv2.INTER_NEAREST
+            small[name] = cv2.resize(value, size, interpolation=interpolation)
+
+    result = result.copy()
+    result.thumbnail((max_side, max_side), Image.BILINEAR)
+    return small, result
+
+def job_bytes(intermediates, result):
+    return (sum(value.nbytes for value in intermediates.values() if isinstance(value, np.ndarray))
+            + result.width * result.height * len(result.getbands()))
+
+class DebugRenderer:
+    """
+    Renders segmentation debug visualizations for a sample of requests on a
+    background thread.
+
+    Requests ask should_sample() before segmenting, run segment_leg with
+    collect_intermediates=True when sampled, and submit() the intermediates once
+    the response has been sent. Jobs are downscaled to max_side pixels and the
+    queue is bounded by the bytes of the images it holds; a job that does not
+    fit is dropped rather than holding the images in memory or blocking a request.
+    """
+    def __init__(self, output_dir, sample_rate=0.0, max_queue_bytes=64 * 1024 * 1024, max_side=1024):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.max_queue_bytes = max_queue_bytes
+        self.max_side = max_side
+        self.jobs = queue.Queue()
+        self.queued_bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {"sampled": 0, "rendered": 0, "dropped": 0, "failed": 0, "render_ms_total": 0.0}
+        self.thread = None
+
+    def start(self):
+        if self.sample_rate <= 0 or self.thread is not None:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self.work, name='debug-renderer', daemon=True)
+        self.thread.start()
+
+    def should_sample(self):
+        if self.thread is None or random.random() >= self.sample_rate:
+            return False
+        with self.lock:
+            self.counters["sampled"] += 1
+        return True
+
+    def submit(self, name, intermediates, result):
+        """Queue one render job; returns False if the queue was full"""
+        stem = f"{int(time.time() * 1000)}-{os.path.splitext(os.path.basename(name))[0]}"
+        intermediates, result = downscale_intermediates(intermediates, result, self.max_side)
+        size = job_bytes(intermediates, result)
+        with self.lock:
+            if self.queued_bytes + size > self.max_queue_bytes:
+                self.counters["dropped"] += 1
+                return False
+            self.queued_bytes += size
+        self.jobs.put((stem, intermediates, result, size))
+        return True
+
+    def work(self):
+        while True:
+            stem, intermediates, result, size = self.jobs.get()
+            start = time.perf_counter()
+            try:
+                render_debug_artifacts(intermediates, result, self.output_dir, stem)
+                outcome = "rendered"
+            except Exception as e:
+                logger.error(f"Debug rendering of {stem} failed: {e}")
+                outcome = "failed"
+            with self.lock:
+                self.queued_bytes -= size
+                self.counters[outcome] += 1
+                self.counters["render_ms_total"] += (time.perf_counter() - start) * 1000
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = dict(self.counters)
+            snapshot["queued_bytes"] = self.queued_bytes
+        snapshot["enabled"] = self.thread is not None
+        snapshot["sample_rate"] = self.sample_rate
+        snapshot["queue_depth"] = self.jobs.qsize()
+        return snapshot
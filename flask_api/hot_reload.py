@@ -0,0 +1,239 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from models.architecture import descriptor_path, load_checkpoint
+
+logger = logging.getLogger(__name__)
+
+# One loaded model. Requests take the current version once and use it for the
+# whole request, so a swap never mixes two models within a prediction.
+ModelVersion = namedtuple('ModelVersion', ['version', 'checkpoint', 'mtime', 'model', 'transform',
+                                           'input_size', 'loaded_at'])
+
+def file_state(path):
+    """(mtime, size) of a file, or None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+def checkpoint_state(checkpoint_path):
+    """
+    State of a checkpoint and its descriptor, or None if the checkpoint does
+    not exist. Either file changing is a new checkpoint.
+    """
+    state = file_state(checkpoint_path)
+    if state is None:
+        return None
+    return state, file_state(descriptor_path(checkpoint_path))
+
+class ModelSlot:
+    """
+    Holds the serving model and replaces it without downtime.
+
+    A new checkpoint is loaded and warmed up next to the current model, then
+    published by rebinding `current`, which is atomic. Requests that already
+    hold the old version finish with it. on_swap, if given, is called with the
+    previous and the new version whenever a serving model is replaced.
+    """
+    def __init__(self, device, make_transform, warmup_runs=3, on_swap=None):
+        self.device = device
+        self.make_transform = make_transform
+        self.warmup_runs = warmup_runs
+        self.on_swap = on_swap
+        self.current = None
+        self.reload_lock = threading.Lock()
+        self.version_lock = threading.Lock()
+        self.versions_loaded = 0
+        self.watcher = None
+
+    def load(self, checkpoint_path):
+        """Load and warm up a checkpoint as a new version without publishing it"""
+        state = file_state(checkpoint_path)
+        model, descriptor = load_checkpoint(checkpoint_path, self.device)
+        input_size = descriptor['input_size']
+
+        # The first forwards allocate buffers and pick kernels; do them before
+        # the model sees traffic
+        warmup_input = torch.zeros(1, 3, input_size, input_size, device=self.device)
+        with torch.no_grad():
+            for _ in range(self.warmup_runs):
+                model(warmup_input)
+
+        with self.version_lock:
+            self.versions_loaded += 1
+            version = self.versions_loaded
+        return ModelVersion(version, checkpoint_path, state[0] if state else None, model,
+                            self.make_transform(input_size), input_size, time.time())
+
+    def swap(self, version):
+        """Publish a loaded version; callers hold reload_lock"""
+        previous = self.current
+        self.current = version
+        logger.info(f"Serving model version {version.version} from {version.checkpoint}"
+                    + (f" (was version {previous.version})" if previous else ""))
+        if previous is not None and self.on_swap:
+            self.on_swap(previous, version)
+        return previous
+
+    def reload(self, checkpoint_path):
+        """Load, warm up and swap in a checkpoint; returns the new version"""
+        # One reload at a time, so the watcher and an admin call cannot interleave
+        with self.reload_lock:
+            version = self.load(checkpoint_path)
+            self.swap(version)
+        return version
+
+    def watch(self, checkpoint_path, interval, on_change=None):
+        """
+        Poll the mtime and size of the checkpoint and its descriptor every
+        `interval` seconds and reload when they change.
+
+        A change is only acted on once it is the same on two consecutive polls,
+        so a checkpoint that is still being written is not loaded. A state only
+        counts as served once it loaded; after a failure (e.g. the weights
+        landed before their descriptor) it is retried. on_change, if given, is
+        called with the path instead of swapping directly.
+        """
+        def poll():
+            served = checkpoint_state(checkpoint_path)
+            pending = None
+            while True:
+                time.sleep(interval)
+                state = checkpoint_state(checkpoint_path)
+                if state is None or state == served:
+                    pending = None
+                    continue
+                if state != pending:
+                    pending = state
+                    continue
+                try:
+                    if on_change:
+                        on_change(checkpoint_path)
+                    else:
+                        self.reload(checkpoint_path)
+                except Exception as e:
+                    logger.error(f"Reloading {checkpoint_path} failed, keeping the current model "
+                                 f"and retrying: {e}")
+                    pending = None
+                    continue
+                served, pending = state, None
+
+        self.watcher = threading.Thread(target=poll, name='checkpoint-watcher', daemon=True)
+        self.watcher.start()
+
+    def describe(self):
+        current = self.current
+        if current is None:
+            return None
+        return {"version": current.version, "checkpoint": current.checkpoint,
+                "checkpoint_mtime": current.mtime, "input_size": current.input_size,
+                "loaded_at": current.loaded_at}
+
+class ShadowScorer:
+    """
+    Runs a candidate model on a sample of requests in a background thread and
+    compares it with the model version that served them.
+
+    The served prediction may come from TTA or the cascade's stage-1 model, so
+    both the serving version and the candidate classify the plain view on the
+    worker and are compared like for like. When the worker is still busy with
+    earlier requests the sample is dropped, so shadow scoring never queues up
+    work or delays responses.
+    """
+    def __init__(self, device, sample_rate=0.1, max_pending=4, log_every=100):
+        self.device = device
+        self.sample_rate = sample_rate
+        self.log_every = log_every
+        self.candidate = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shadow')
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {"sampled": 0, "compared": 0, "agreed": 0, "dropped": 0, "failed": 0,
+                             "abs_prob_diff_total": 0.0, "active_ms_total": 0.0, "shadow_ms_total": 0.0}
+
+    def set_candidate(self, version):
+        self.candidate = version
+        self.reset()
+        if version is not None:
+            logger.info(f"Shadow scoring version {version.version} from {version.checkpoint}")
+
+    def should_sample(self):
+        return self.candidate is not None and random.random() < self.sample_rate
+
+    def submit(self, image, active):
+        """Queue a comparison of the candidate with `active`, the version that served the request"""
+        candidate = self.candidate
+        if candidate is None:
+            return
+        if not self.pending.acquire(blocking=False):
+            with self.lock:
+                self.counters["dropped"] += 1
+            return
+        with self.lock:
+            self.counters["sampled"] += 1
+        self.executor.submit(self.score, candidate, active, image)
+
+    def classify(self, version, image):
+        """Plain-view probabilities of one version and the time they took in ms"""
+        start = time.perf_counter()
+        input_tensor = version.transform(image).unsqueeze(0).to(self.device)
+        with torch.no_grad():
+            probs = torch.nn.functional.softmax(version.model(input_tensor), dim=1)[0].cpu().numpy()
+        return probs, (time.perf_counter() - start) * 1000
+
+    def score(self, candidate, active, image):
+        try:
+            active_probs, active_ms = self.classify(active, image)
+            probs, shadow_ms = self.classify(candidate, image)
+        except Exception as e:
+            logger.error(f"Shadow scoring failed: {e}")
+            with self.lock:
+                self.counters["failed"] += 1
+            return
+        finally:
+            self.pending.release()
+
+        # Ignore results of a candidate that was replaced while this was running
+        if candidate is not self.candidate:
+            return
+        with self.lock:
+            counters = self.counters
+            counters["compared"] += 1
+            counters["agreed"] += int(np.argmax(probs) == np.argmax(active_probs))
+            counters["abs_prob_diff_total"] += float(np.abs(probs - active_probs).max())
+            counters["active_ms_total"] += active_ms
+            counters["shadow_ms_total"] += shadow_ms
+            compared = counters["compared"]
+        if compared % self.log_every == 0:
+            stats = self.snapshot()
+            logger.info(f"Shadow version {candidate.version}: {stats['agreement']*100:.1f}% agreement "
+                        f"over {compared} requests, {stats['mean_shadow_ms']:.1f} ms vs "
+                        f"{stats['mean_active_ms']:.1f} ms for version {active.version}")
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = dict(self.counters)
+        candidate = self.candidate
+        compared = snapshot["compared"]
+        snapshot["candidate_version"] = candidate.version if candidate else None
+        snapshot["candidate_checkpoint"] = candidate.checkpoint if candidate else None
+        snapshot["sample_rate"] = self.sample_rate
+        snapshot["agreement"] = snapshot["agreed"] / compared if compared else 0.0
+        snapshot["mean_max_abs_prob_diff"] = snapshot["abs_prob_diff_total"] / compared if compared else 0.0
+        snapshot["mean_active_ms"] = snapshot["active_ms_total"] / compared if compared else 0.0
+        snapshot["mean_shadow_ms"] = snapshot["shadow_ms_total"] / compared if compared else 0.0
+        return snapshot
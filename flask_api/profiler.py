@@ -0,0 +1,119 @@
+import io
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import zipfile
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import torch
+
+class ProfileSession:
+    """
+    Time-boxed profile of live traffic.
+
+    While running it collects:
+      - Python stacks of every request thread, sampled from sys._current_frames()
+        every `interval` seconds, in collapsed format (one "frame;frame;frame count"
+        line per stack, readable by flamegraph.pl and speedscope)
+      - torch operator timings of model forwards wrapped in torch_profile()
+        (one request at a time; concurrent requests run unprofiled)
+      - tracemalloc allocation statistics at the end of the session
+
+    Nothing is hooked in between sessions: callers only check whether a session
+    is active.
+    """
+    def __init__(self, duration, interval=0.005, top_n=25, frame_filter=None):
+        self.duration = duration
+        self.interval = interval
+        self.top_n = top_n
+        # Only stacks containing a frame whose function is in frame_filter are kept
+        self.frame_filter = frame_filter
+        self.stacks = Counter()
+        self.samples = 0
+        self.torch_ops = defaultdict(lambda: {'count': 0, 'self_cpu_us': 0.0, 'cpu_us': 0.0})
+        self.torch_profiled = 0
+        self.torch_lock = threading.Lock()
+        self.sampler_thread = None
+        self.stop_event = threading.Event()
+
+    def run(self):
+        """Profile for `duration` seconds and return the artifact as zip bytes"""
+        tracemalloc.start(25)
+        started = time.time()
+        self.sampler_thread = threading.Thread(target=self.sample_stacks, name='profile-sampler', daemon=True)
+        self.sampler_thread.start()
+        try:
+            self.stop_event.wait(self.duration)
+        finally:
+            self.stop_event.set()
+            self.sampler_thread.join()
+            snapshot = tracemalloc.take_snapshot()
+            traced_current, traced_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        allocations = [{
+            'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            'size_bytes': stat.size,
+            'count': stat.count
+        } for stat in snapshot.statistics('lineno')[:self.top_n]]
+
+        summary = {
+            'started': started,
+            'duration_s': time.time() - started,
+            'sample_interval_s': self.interval,
+            'stack_samples': self.samples,
+            'torch_profiled_requests': self.torch_profiled,
+            'traced_memory_bytes': traced_current,
+            'traced_peak_bytes': traced_peak
+        }
+        torch_ops = sorted(({'op': name, **stats} for name, stats in self.torch_ops.items()),
+                           key=lambda op: op['self_cpu_us'], reverse=True)
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as artifact:
+            artifact.writestr('stacks.collapsed',
+                              ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()))
+            artifact.writestr('torch_ops.json', json.dumps(torch_ops, indent=2))
+            artifact.writestr('allocations.json', json.dumps(allocations, indent=2))
+            artifact.writestr('summary.json', json.dumps(summary, indent=2))
+        return buffer.getvalue()
+
+    def sample_stacks(self):
+        own_thread = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append((code.co_name, f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"))
+                    frame = frame.f_back
+                if self.frame_filter and not any(name in self.frame_filter for name, _ in frames):
+                    continue
+                thread_name = names.get(thread_id) or f"thread-{thread_id}"
+                self.stacks[';'.join([thread_name] + [label for _, label in reversed(frames)])] += 1
+                self.samples += 1
+
+    @contextmanager
+    def torch_profile(self):
+        """Record torch operators inside the block, unless another request is being recorded"""
+        if not self.torch_lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as prof:
+                yield
+            for event in prof.key_averages():
+                op = self.torch_ops[event.key]
+                op['count'] += event.count
+                op['self_cpu_us'] += event.self_cpu_time_total
+                op['cpu_us'] += event.cpu_time_total
+            self.torch_profiled += 1
+        finally:
+            self.torch_lock.release()
@@ -0,0 +1,186 @@
+import json
+import os
+import time
+import torch
+import torch.nn as nn
+from torchvision import models
+
+# Model architectures used by training, the API and the export scripts.
+#
+# A checkpoint's architecture is recorded in a descriptor file next to it
+# (best_model.pth -> best_model.json). Checkpoints without a descriptor are
+# the stock MobileNetV2 from train.py.
+
+NUM_CLASSES = 3
+DEFAULT_DESCRIPTOR = {'arch': 'mobilenet_v2', 'width_mult': 1.0, 'input_size': 224}
+
+def descriptor_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + '.json'
+
+def save_descriptor(checkpoint_path, descriptor):
+    """Write the architecture descriptor next to a checkpoint"""
+    with open(descriptor_path(checkpoint_path), 'w') as f:
+        json.dump(descriptor, f, indent=2)
+
+def load_descriptor(checkpoint_path):
+    """Read the descriptor of a checkpoint, defaulting to the stock MobileNetV2"""
+    path = descriptor_path(checkpoint_path)
+    descriptor = dict(DEFAULT_DESCRIPTOR)
+    if os.path.exists(path):
+        with open(path) as f:
+            descriptor.update(json.load(f))
+    return descriptor
+
+def build_model(descriptor=None, pretrained=False):
+    """Create the (untrained) network described by a descriptor"""
+    descriptor = descriptor or DEFAULT_DESCRIPTOR
+    arch = descriptor['arch']
+
+    if arch == 'mobilenet_v2':
+        width_mult = descriptor.get('width_mult', 1.0)
+        # ImageNet weights only exist for the full-width network
+        model = models.mobilenet_v2(pretrained=pretrained and width_mult == 1.0, width_mult=width_mult)
+        model.classifier[1] = nn.Linear(model.last_channel, NUM_CLASSES)
+    elif arch == 'pruned_mobilenet_v2':
+        # Dense MobileNetV2 with fewer channels, produced by models/prune.py
+        model = models.mobilenet_v2(width_mult=descriptor.get('width_mult', 1.0))
+        hidden_keep = [list(range(channels)) for channels in descriptor['hidden_channels']]
+        last_keep = list(range(descriptor['last_channel']))
+        prune_mobilenet_v2(model, hidden_keep, last_keep)
+    elif arch == 'mobilenet_v3_small':
+        model = models.mobilenet_v3_small(pretrained=pretrained)
+        model.classifier[3] = nn.Linear(model.classifier[3].in_features, NUM_CLASSES)
+    else:
+        raise ValueError(f"Unknown architecture '{arch}'")
+
+    return model
+
+def expanding_blocks(model):
+    """Inverted-residual blocks of a MobileNetV2 that have a 1x1 expansion layer"""
+    return [block for block in model.features
+            if hasattr(block, 'conv') and len(block.conv) == 4]
+
+def _slice_conv(conv, out_keep=None, in_keep=None):
+    """Copy of a Conv2d with only the given output/input channels"""
+    depthwise = conv.groups > 1 and conv.groups == conv.in_channels
+    out_channels = len(out_keep) if out_keep is not None else conv.out_channels
+    in_channels = len(in_keep) if in_keep is not None else conv.in_channels
+    new_conv = nn.Conv2d(in_channels, out_channels, conv.kernel_size, conv.stride, conv.padding,
+                         conv.dilation, groups=out_channels if depthwise else conv.groups,
+                         bias=conv.bias is not None)
+
+    weight = conv.weight.data
+    if out_keep is not None:
+        weight = weight[out_keep]
+    if in_keep is not None and not depthwise:
+        weight = weight[:, in_keep]
+    new_conv.weight.data = weight.clone()
+    if conv.bias is not None:
+        bias = conv.bias.data
+        new_conv.bias.data = (bias[out_keep] if out_keep is not None else bias).clone()
+    return new_conv
+
+def _slice_bn(bn, keep):
+    new_bn = nn.BatchNorm2d(len(keep), eps=bn.eps, momentum=bn.momentum)
+    new_bn.weight.data = bn.weight.data[keep].clone()
+    new_bn.bias.data = bn.bias.data[keep].clone()
+    new_bn.running_mean = bn.running_mean[keep].clone()
+    new_bn.running_var = bn.running_var[keep].clone()
+    return new_bn
+
+def prune_mobilenet_v2(model, hidden_keep, last_keep):
+    """
+    Remove channels from a MobileNetV2 in place, producing a smaller dense network.
+    
+    Args:
+        model: MobileNetV2 (with or without the 3-class head)
+        hidden_keep: Per expanding block, the expansion channels to keep
+        last_keep: Channels of the final 1x1 convolution (last_channel) to keep
+        
+    Returns:
+        The model, with a 3-class classifier over the kept last channels
+    """
+    blocks = expanding_blocks(model)
+    if len(hidden_keep) != len(blocks):
+        raise ValueError(f"Expected {len(blocks)} hidden channel lists, got {len(hidden_keep)}")
+
+    for block, keep in zip(blocks, hidden_keep):
+        keep = torch.as_tensor(keep, dtype=torch.long)
+        expand, depthwise, project = block.conv[0], block.conv[1], block.conv[2]
+        # Expansion 1x1 conv -> depthwise conv -> projection 1x1 conv all share the hidden channels
+        expand[0] = _slice_conv(expand[0], out_keep=keep)
+        expand[1] = _slice_bn(expand[1], keep)
+        depthwise[0] = _slice_conv(depthwise[0], out_keep=keep, in_keep=keep)
+        depthwise[1] = _slice_bn(depthwise[1], keep)
+        block.conv[2] = _slice_conv(project, in_keep=keep)
+
+    last_keep = torch.as_tensor(last_keep, dtype=torch.long)
+    final_conv = model.features[-1]
+    final_conv[0] = _slice_conv(final_conv[0], out_keep=last_keep)
+    final_conv[1] = _slice_bn(final_conv[1], last_keep)
+
+    old_head = model.classifier[1]
+    new_head = nn.Linear(len(last_keep), NUM_CLASSES)
+    if old_head.out_features == NUM_CLASSES:
+        new_head.weight.data = old_head.weight.data[:, last_keep].clone()
+        new_head.bias.data = old_head.bias.data.clone()
+    model.classifier[1] = new_head
+    model.last_channel = len(last_keep)
+    return model
+
+def load_checkpoint(checkpoint_path, device='cpu'):
+    """Rebuild a model from its checkpoint and descriptor.
+
+    Returns:
+        (model in eval mode on device, descriptor)
+    """
+    descriptor = load_descriptor(checkpoint_path)
+    model = build_model(descriptor)
+    model.load_state_dict(torch.load(checkpoint_path, map_location=device))
+    model = model.to(device)
+    model.eval()
+    return model, descriptor
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+def count_flops(model, input_size):
+    """Multiply-accumulate operations of one forward pass (convolutions and linear layers)"""
+    flops = []
+
+    def conv_hook(module, inputs, output):
+        kernel_ops = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+        flops.append(output.numel() * kernel_ops)
+
+    def linear_hook(module, inputs, output):
+        flops.append(output.numel() * module.in_features)
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(torch.rand(1, 3, input_size, input_size, device=next(model.parameters()).device))
+    model.train(was_training)
+    for handle in handles:
+        handle.remove()
+    return sum(flops)
+
+def measure_cpu_latency(model, input_size, runs=50, warmup=5):
+    """Median single-image CPU latency of a model in milliseconds"""
+    model = model.to('cpu').eval()
+    example_input = torch.rand(1, 3, input_size, input_size)
+    timings = []
+    with torch.no_grad():
+        for i in range(warmup + runs):
+            start = time.perf_counter()
+            model(example_input)
+            if i >= warmup:
+                timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
@@ -0,0 +1,230 @@
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from PIL import Image
+
+from architecture import load_checkpoint, load_descriptor
+from segment_leg import segment_leg
+from train import device
+
+CLASS_NAMES = ['normal', 'moderate', 'severe']
+IMAGE_EXTENSIONS = ('.bmp', '.jpg', '.jpeg', '.png')
+PROGRESS_FILE = '_progress.json'
+
+def iter_image_paths(source):
+    """
+    Stream image paths from a directory tree or a manifest file.
+
+    Directories are walked in sorted order so the sequence is the same on every
+    run, which is what lets an interrupted job resume by position (skip_consumed
+    checks that the already scored prefix did not change). A manifest is
+    a text/CSV file whose first column is an image path (a 'path' header is skipped).
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(root, name)
+    else:
+        with open(source, newline='') as f:
+            for row in csv.reader(f):
+                if row and row[0] != 'path':
+                    yield row[0]
+
+def init_worker():
+    # Each worker handles one image at a time; avoid oversubscribing the CPU
+    import cv2
+    cv2.setNumThreads(1)
+    torch.set_num_threads(1)
+
+def preprocess(task):
+    """Decode, segment and resize one image. Runs in a worker process."""
+    path, input_size = task
+    start = time.perf_counter()
+    details = {}
+    error = None
+    try:
+        image = segment_leg(path, None, visualize_seeds=False, details=details).convert('RGB')
+        method = details.get('method', 'unknown')
+    except Exception as e:
+        # Score the original image when segmentation fails, like the API does
+        method = 'original'
+        error = str(e)
+        try:
+            image = Image.open(path).convert('RGB')
+        except Exception as e:
+            return {'path': path, 'pixels': None, 'method': 'unreadable', 'error': str(e),
+                    'preprocess_ms': (time.perf_counter() - start) * 1000}
+
+    # Resize here so only input_size x input_size uint8 pixels travel back to the parent
+    pixels = np.asarray(image.resize((input_size, input_size), Image.BILINEAR), dtype=np.uint8)
+    return {'path': path, 'pixels': pixels, 'method': method, 'error': error,
+            'preprocess_ms': (time.perf_counter() - start) * 1000}
+
+def score_chunk(model, results, batch_size):
+    """Batched inference over preprocessed images; returns output rows in input order"""
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+    probs = {}
+    inference_ms = {}
+
+    scorable = [i for i, r in enumerate(results) if r['pixels'] is not None]
+    for start in range(0, len(scorable), batch_size):
+        batch_indices = scorable[start:start + batch_size]
+        batch = torch.from_numpy(np.stack([results[i]['pixels'] for i in batch_indices]))
+        batch = (batch.permute(0, 3, 1, 2).float() / 255 - mean) / std
+
+        begin = time.perf_counter()
+        with torch.no_grad():
+            batch_probs = torch.softmax(model(batch.to(device)), dim=1).cpu().numpy()
+        per_image_ms = (time.perf_counter() - begin) * 1000 / len(batch_indices)
+
+        for i, p in zip(batch_indices, batch_probs):
+            probs[i] = p
+            inference_ms[i] = per_image_ms
+
+    rows = []
+    for i, r in enumerate(results):
+        p = probs.get(i)
+        rows.append({
+            'path': r['path'],
+            'prob_normal': float(p[0]) if p is not None else None,
+            'prob_moderate': float(p[1]) if p is not None else None,
+            'prob_severe': float(p[2]) if p is not None else None,
+            'predicted_class': CLASS_NAMES[int(p.argmax())] if p is not None else None,
+            'segmentation_method': r['method'],
+            'preprocess_ms': r['preprocess_ms'],
+            'inference_ms': inference_ms.get(i),
+            'error': r['error']
+        })
+    return rows
+
+def write_part(output_dir, part, rows):
+    """Write one chunk as a Parquet file, atomically"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Explicit schema so every part has the same column types, even when a
+    # chunk has no successfully scored images
+    schema = pa.schema([
+        ('path', pa.string()),
+        ('prob_normal', pa.float32()),
+        ('prob_moderate', pa.float32()),
+        ('prob_severe', pa.float32()),
+        ('predicted_class', pa.string()),
+        ('segmentation_method', pa.string()),
+        ('preprocess_ms', pa.float32()),
+        ('inference_ms', pa.float32()),
+        ('error', pa.string())
+    ])
+    table = pa.Table.from_pylist(rows, schema=schema)
+    path = os.path.join(output_dir, f'part-{part:05d}.parquet')
+    pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return path
+
+def load_progress(output_dir, source, checkpoint):
+    path = os.path.join(output_dir, PROGRESS_FILE)
+    if not os.path.exists(path):
+        return {'source': source, 'checkpoint': checkpoint, 'consumed': 0, 'parts': 0, 'scored': 0,
+                'last_path': None, 'prefix_sha256': hashlib.sha256().hexdigest()}
+    with open(path) as f:
+        progress = json.load(f)
+    if progress['source'] != source or progress['checkpoint'] != checkpoint:
+        raise ValueError(f"{output_dir} holds results for {progress['source']} scored with "
+                         f"{progress['checkpoint']}; use a new output directory")
+    return progress
+
+def skip_consumed(paths, progress, digest):
+    """
+    Advance the path stream past the images an earlier run already scored.
+
+    The skipped paths are hashed into digest and compared with the hash and last
+    path stored in the progress file. Files added to or removed from the scored
+    part of the tree since then would shift every later position, so that is an
+    error instead of silently skipping or rescoring images.
+    """
+    last_path = None
+    for last_path in itertools.islice(paths, progress['consumed']):
+        digest.update(last_path.encode() + b'\n')
+    if digest.hexdigest() != progress.get('prefix_sha256') or last_path != progress.get('last_path'):
+        raise ValueError(f"The first {progress['consumed']} images of {progress['source']} are not the ones "
+                         f"scored before (expected the last to be {progress.get('last_path')}, found {last_path}); "
+                         f"the source changed since the interrupted run, use a new output directory")
+    return paths
+
+def save_progress(output_dir, progress):
+    path = os.path.join(output_dir, PROGRESS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(progress, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Score a directory tree or manifest of leg photos')
+    parser.add_argument('source', help='Image directory or manifest file (one path per line / CSV)')
+    parser.add_argument('output_dir', help='Directory for Parquet parts and progress')
+    parser.add_argument('--checkpoint', default='models/checkpoints/best_model.pth')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Processes that decode and segment images')
+    parser.add_argument('--chunk-size', type=int, default=512, help='Images per output part and checkpoint')
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    progress = load_progress(args.output_dir, args.source, args.checkpoint)
+    if progress['consumed']:
+        print(f"Resuming after {progress['consumed']} images ({progress['parts']} parts written)")
+
+    input_size = load_descriptor(args.checkpoint)['input_size']
+
+    # Skip what an earlier run already scored. Only the position and a hash of
+    # the scored paths are remembered, so memory does not grow with the archive.
+    digest = hashlib.sha256()
+    paths = skip_consumed(iter_image_paths(args.source), progress, digest)
+    tasks = ((path, input_size) for path in paths)
+
+    def next_chunk():
+        return list(itertools.islice(tasks, args.chunk_size))
+
+    start = time.time()
+    scored_this_run = 0
+    with Pool(args.workers, initializer=init_worker) as pool:
+        # Load the model only after the workers have been forked
+        model, _ = load_checkpoint(args.checkpoint, device)
+        chunk = next_chunk()
+        pending = pool.map_async(preprocess, chunk, chunksize=8) if chunk else None
+        while pending is not None:
+            results = pending.get()
+            # Start decoding the next chunk while this one is scored and written
+            chunk = next_chunk()
+            pending = pool.map_async(preprocess, chunk, chunksize=8) if chunk else None
+
+            rows = score_chunk(model, results, args.batch_size)
+            part_path = write_part(args.output_dir, progress['parts'], rows)
+            progress['parts'] += 1
+            progress['consumed'] += len(rows)
+            for row in rows:
+                digest.update(row['path'].encode() + b'\n')
+            progress['prefix_sha256'] = digest.hexdigest()
+            progress['last_path'] = rows[-1]['path']
+            progress['scored'] += sum(1 for row in rows if row['predicted_class'] is not None)
+            save_progress(args.output_dir, progress)
+
+            scored_this_run += len(rows)
+            rate = scored_this_run / max(time.time() - start, 1e-6)
+            print(f"{progress['consumed']} images done ({rate:.1f} img/s), wrote {part_path}")
+
+    print(f"Finished: {progress['scored']} of {progress['consumed']} images scored "
+          f"into {progress['parts']} parts in {args.output_dir}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import argparse
+import json
+import logging
+import os
+import time
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from segment_leg import segment_leg
+
+logger = logging.getLogger('bulk_segment')
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpg', '.jpeg', '.png')
+
+# Output encodings: PNG with the fastest zlib level is lossless and several
+# times quicker to write than the default level
+OUTPUT_FORMATS = {
+    'png-fast': ('.png', {'compress_level': 1}),
+    'png': ('.png', {}),
+    'jpg': ('.jpg', {'quality': 95})
+}
+
+def output_paths(input_path, input_dir, output_dir, extension):
+    """Segmented image and mask paths, mirroring the input tree under output_dir"""
+    relative = os.path.relpath(input_path, input_dir)
+    stem = os.path.join(output_dir, os.path.splitext(relative)[0])
+    return f"{stem}_segmented{extension}", f"{stem}_mask.png"
+
+def is_up_to_date(input_path, outputs):
+    input_mtime = os.path.getmtime(input_path)
+    return all(os.path.exists(path) and os.path.getmtime(path) >= input_mtime for path in outputs)
+
+def save_atomic(image, path, **save_kwargs):
+    # Write under a temporary name so an interrupted run never leaves a truncated
+    # file that looks up to date
+    root, extension = os.path.splitext(path)
+    tmp_path = f"{root}.tmp{extension}"
+    image.save(tmp_path, **save_kwargs)
+    os.replace(tmp_path, path)
+
+def init_worker():
+    # One image per process; OpenCV's own threads would only oversubscribe the CPU
+    import cv2
+    cv2.setNumThreads(1)
+
+def segment_one(task):
+    """Segment one image and write its outputs. Runs in a worker process."""
+    input_path, segmented_path, mask_path, save_kwargs = task
+    start = time.perf_counter()
+    details = {}
+    try:
+        os.makedirs(os.path.dirname(segmented_path), exist_ok=True)
+        segmented = segment_leg(input_path, None, visualize_seeds=False, details=details)
+        save_atomic(segmented, segmented_path, **save_kwargs)
+        save_atomic(Image.fromarray(details['mask']), mask_path, compress_level=1)
+        error = None
+    except Exception as e:
+        error = str(e)
+    return input_path, details.get('method', 'failed'), (time.perf_counter() - start) * 1000, error
+
+def iter_tasks(input_dir, output_dir, extension, save_kwargs, force, skipped):
+    """Yield work for every image that is missing or older than its outputs"""
+    output_root = os.path.realpath(output_dir)
+    for root, dirs, files in os.walk(input_dir):
+        # An output tree inside the input tree is not walked, so outputs are
+        # never segmented again
+        dirs[:] = sorted(d for d in dirs if os.path.realpath(os.path.join(root, d)) != output_root)
+        for name in sorted(files):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            input_path = os.path.join(root, name)
+            segmented_path, mask_path = output_paths(input_path, input_dir, output_dir, extension)
+            if not force and is_up_to_date(input_path, (segmented_path, mask_path)):
+                skipped[0] += 1
+                continue
+            yield input_path, segmented_path, mask_path, save_kwargs
+
+def main():
+    parser = argparse.ArgumentParser(description='Segment every leg image in a directory tree')
+    parser.add_argument('input_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--format', choices=sorted(OUTPUT_FORMATS), default='png-fast',
+                        help='Encoding of the segmented images (masks are always PNG)')
+    parser.add_argument('--force', action='store_true', help='Re-segment images whose outputs are up to date')
+    parser.add_argument('--log-every', type=int, default=100, help='Progress log interval in images')
+    args = parser.parse_args()
+    if os.path.realpath(args.output_dir) == os.path.realpath(args.input_dir):
+        parser.error('output_dir must differ from input_dir, or the outputs are segmented on the next run')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    extension, save_kwargs = OUTPUT_FORMATS[args.format]
+
+    skipped = [0]
+    methods = Counter()
+    latencies = []
+    failures = []
+    start = time.time()
+
+    tasks = iter_tasks(args.input_dir, args.output_dir, extension, save_kwargs, args.force, skipped)
+    with Pool(args.workers, initializer=init_worker) as pool:
+        for input_path, method, latency_ms, error in pool.imap_unordered(segment_one, tasks, chunksize=4):
+            methods[method] += 1
+            latencies.append(latency_ms)
+            if error:
+                failures.append({'path': input_path, 'error': error})
+            if len(latencies) % args.log_every == 0:
+                logger.info(f"{len(latencies)} segmented, {skipped[0]} up to date, "
+                            f"{len(failures)} failed ({len(latencies) / (time.time() - start):.1f} img/s)")
+
+    percentiles = {}
+    if latencies:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        percentiles = {'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(max(latencies))}
+
+    summary = {
+        'input_dir': args.input_dir,
+        'output_dir': args.output_dir,
+        'segmented': len(latencies) - len(failures),
+        'skipped_up_to_date': skipped[0],
+        'failed': len(failures),
+        'methods': dict(methods),
+        'latency_ms': percentiles,
+        'wall_time_s': time.time() - start,
+        'failures': failures
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    summary_path = os.path.join(args.output_dir, 'segmentation_summary.json')
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    logger.info(f"Segmented {summary['segmented']} images, {skipped[0]} already up to date, "
+                f"{len(failures)} failed in {summary['wall_time_s']:.1f}s")
+    for method, count in methods.most_common():
+        logger.info(f"  {method}: {count}")
+    if percentiles:
+        logger.info(f"Latency p50 {percentiles['p50']:.0f} ms, p90 {percentiles['p90']:.0f} ms, "
+                    f"p99 {percentiles['p99']:.0f} ms")
+    logger.info(f"Summary saved to {summary_path}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import json
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader
+
+from architecture import load_checkpoint, save_descriptor
+from train import PackedDataset, pack_dataset, split_indices, get_packed_transforms, create_model, train_model, device
+
+# Stage-1 architectures that can be trained by this script
+STAGE1_ARCHITECTURES = {
+    'mobilenet_v3_small': {'arch': 'mobilenet_v3_small', 'input_size': 224},
+    'mobilenet_v2_128': {'arch': 'mobilenet_v2', 'width_mult': 1.0, 'input_size': 128},
+    'mobilenet_v2_0.5_128': {'arch': 'mobilenet_v2', 'width_mult': 0.5, 'input_size': 128}
+}
+
+def predict_probabilities(model, images, labels, indices):
+    """Softmax outputs of a model over a PackedDataset view"""
+    _, val_transform = get_packed_transforms()
+    loader = DataLoader(PackedDataset(images, labels, indices, transform=val_transform),
+                        batch_size=64, shuffle=False, num_workers=0)
+    outputs = []
+    with torch.no_grad():
+        for batch, _ in loader:
+            outputs.append(torch.softmax(model(batch.to(device)), dim=1).cpu().numpy())
+    return np.concatenate(outputs)
+
+def calibrate_threshold(stage1_probs, full_probs, labels, tolerance=0.0):
+    """
+    Find the stage-1 confidence threshold that escalates the fewest images while
+    keeping cascade accuracy within `tolerance` (fraction) of the full model.
+
+    Returns:
+        Dict with the threshold, accuracies and escalation rate
+    """
+    stage1_conf = stage1_probs.max(axis=1)
+    stage1_pred = stage1_probs.argmax(axis=1)
+    full_pred = full_probs.argmax(axis=1)
+    full_acc = float((full_pred == labels).mean())
+
+    # Candidate thresholds sorted so the first one that passes escalates the least.
+    # A threshold above every confidence escalates everything and always passes.
+    candidates = np.concatenate([np.unique(stage1_conf), [1.0 + 1e-6]])
+    for threshold in candidates:
+        escalate = stage1_conf < threshold
+        cascade_pred = np.where(escalate, full_pred, stage1_pred)
+        cascade_acc = float((cascade_pred == labels).mean())
+        if cascade_acc >= full_acc - tolerance:
+            return {
+                'threshold': float(threshold),
+                'full_accuracy': full_acc,
+                'stage1_accuracy': float((stage1_pred == labels).mean()),
+                'cascade_accuracy': cascade_acc,
+                'escalation_rate': float(escalate.mean())
+            }
+
+def main():
+    parser = argparse.ArgumentParser(description='Train and calibrate the stage-1 model of the inference cascade')
+    parser.add_argument('--data-dir', default='data/CVI-img-datasets-2/imagedata')
+    parser.add_argument('--full-checkpoint', default='models/checkpoints/best_model.pth')
+    parser.add_argument('--stage1', choices=sorted(STAGE1_ARCHITECTURES), default='mobilenet_v3_small')
+    parser.add_argument('--stage1-checkpoint', default='models/checkpoints/cascade_stage1.pth')
+    parser.add_argument('--config-out', default='models/checkpoints/cascade.json')
+    parser.add_argument('--skip-training', action='store_true', help='Only calibrate an existing stage-1 checkpoint')
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help='Accuracy (fraction) the cascade may lose against the full model')
+    parser.add_argument('--calibration-split', choices=['test', 'val'], default='test',
+                        help='Manifest split the threshold is calibrated on; val also selects the checkpoints')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    descriptor = STAGE1_ARCHITECTURES[args.stage1]
+    stage1_size = descriptor['input_size']
+    images, labels = pack_dataset(args.data_dir, size=stage1_size,
+                                  cache_path=f'models/checkpoints/packed_{stage1_size}.pt')
+    train_indices = split_indices(args.data_dir, 'train')
+    val_indices = split_indices(args.data_dir, 'val')
+    # Both checkpoints were selected on the val split, so calibrating there would
+    # make the threshold look better than it is
+    calibration_indices = split_indices(args.data_dir, args.calibration_split)
+
+    if not args.skip_training:
+        torch.manual_seed(args.seed)
+        train_transform, val_transform = get_packed_transforms()
+        train_loader = DataLoader(PackedDataset(images, labels, train_indices, transform=train_transform),
+                                  batch_size=32, shuffle=True, num_workers=0)
+        val_loader = DataLoader(PackedDataset(images, labels, val_indices, transform=val_transform),
+                                batch_size=32, shuffle=False, num_workers=0)
+
+        model = create_model(pretrained=True, descriptor=descriptor).to(device)
+        criterion = nn.CrossEntropyLoss()
+        optimizer = optim.Adam(model.parameters(), lr=0.001)
+        train_model(model, train_loader, val_loader, criterion, optimizer,
+                    num_epochs=args.epochs, checkpoint_path=args.stage1_checkpoint)
+        save_descriptor(args.stage1_checkpoint, descriptor)
+
+    stage1_model, _ = load_checkpoint(args.stage1_checkpoint, device)
+    stage1_probs = predict_probabilities(stage1_model, images, labels, calibration_indices)
+
+    # The full model sees the same calibration images at its own resolution
+    full_model, full_descriptor = load_checkpoint(args.full_checkpoint, device)
+    if full_descriptor['input_size'] != stage1_size:
+        images, labels = pack_dataset(args.data_dir, size=full_descriptor['input_size'],
+                                      cache_path=f"models/checkpoints/packed_{full_descriptor['input_size']}.pt")
+    full_probs = predict_probabilities(full_model, images, labels, calibration_indices)
+
+    calibration = calibrate_threshold(stage1_probs, full_probs, labels.numpy()[calibration_indices], args.tolerance)
+    config = {
+        'stage1_checkpoint': args.stage1_checkpoint,
+        'full_checkpoint': args.full_checkpoint,
+        'calibration_split': args.calibration_split,
+        'calibration_size': len(calibration_indices),
+        **calibration
+    }
+    with open(args.config_out, 'w') as f:
+        json.dump(config, f, indent=2)
+
+    print(f"Stage-1 threshold: {calibration['threshold']:.4f}")
+    print(f"Accuracy - stage 1: {calibration['stage1_accuracy']*100:.2f}%, "
+          f"full: {calibration['full_accuracy']*100:.2f}%, cascade: {calibration['cascade_accuracy']*100:.2f}%")
+    print(f"Expected escalation rate: {calibration['escalation_rate']*100:.1f}%")
+    print(f"Cascade config saved to {args.config_out}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import shutil
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+import torch.optim as optim
+from torch.utils.data import DataLoader
+
+from train import PackedDataset, pack_dataset, pack_entries, get_packed_transforms, create_model, train_model
+from manifest import group_key
+
+CLASS_NAMES = ['normal', 'moderate', 'severe']
+
+def stratified_kfold(strata, k=5, seed=42, groups=None, indices=None):
+    """Split sample indices into k folds with the same balance of strata.
+
+    Args:
+        strata: Stratum (class or grade) of every sample
+        groups: Optional group of every sample (e.g. its near-duplicate
+                cluster); all samples of a group land in the same fold, and a
+                group is stratified by its most common stratum
+        indices: Samples to split (default: all)
+
+    Returns:
+        List of (train_indices, val_indices) tuples, one per fold
+    """
+    rng = np.random.RandomState(seed)
+    indices = range(len(strata)) if indices is None else indices
+    members = defaultdict(list)
+    for idx in indices:
+        members[groups[idx] if groups is not None else idx].append(int(idx))
+
+    by_stratum = defaultdict(list)
+    for group_members in members.values():
+        stratum = Counter(strata[idx] for idx in group_members).most_common(1)[0][0]
+        by_stratum[stratum].append(sorted(group_members))
+
+    # Deal the shuffled groups of each stratum to the fold that has the fewest
+    # samples of that stratum so far, largest groups first. Ties go to the
+    # fold with the fewest samples overall, so the remainders of the strata
+    # spread over the folds instead of piling up in fold 0
+    folds = [[] for _ in range(k)]
+    fold_sizes = [0] * k
+    for stratum in sorted(by_stratum):
+        stratum_groups = sorted(by_stratum[stratum])
+        rng.shuffle(stratum_groups)
+        stratum_groups.sort(key=len, reverse=True)
+        counts = [0] * k
+        for group_members in stratum_groups:
+            fold = min(range(k), key=lambda f: (counts[f], fold_sizes[f]))
+            folds[fold].extend(group_members)
+            counts[fold] += len(group_members)
+            fold_sizes[fold] += len(group_members)
+
+    splits = []
+    for fold in range(k):
+        val_indices = sorted(folds[fold])
+        train_indices = sorted(idx for other in range(k) if other != fold for idx in folds[other])
+        splits.append((train_indices, val_indices))
+    return splits
+
+def evaluate_fold(model, val_loader, num_classes=len(CLASS_NAMES)):
+    """Accuracy and per-class recall of a model on one validation fold"""
+    model.eval()
+    confusion = np.zeros((num_classes, num_classes), dtype=int)
+    with torch.no_grad():
+        for images, labels in val_loader:
+            _, predicted = model(images).max(1)
+            for true, pred in zip(labels.numpy(), predicted.numpy()):
+                confusion[true][pred] += 1
+
+    total = confusion.sum()
+    class_totals = confusion.sum(axis=1)
+    return {
+        'accuracy': 100.0 * np.trace(confusion) / max(total, 1),
+        'per_class_recall': {
+            CLASS_NAMES[i]: 100.0 * confusion[i, i] / class_totals[i] if class_totals[i] else None
+            for i in range(num_classes)
+        },
+        'confusion_matrix': confusion.tolist()
+    }
+
+def run_fold(fold, train_indices, val_indices, images, labels, config, num_threads):
+    """Train and evaluate a single fold. Runs inside a worker process."""
+    # Split the CPU between the folds that run at the same time
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(config['seed'] + fold)
+    cpu = torch.device('cpu')
+
+    train_transform, val_transform = get_packed_transforms(config['augment_strength'])
+    train_dataset = PackedDataset(images, labels, train_indices, transform=train_transform)
+    val_dataset = PackedDataset(images, labels, val_indices, transform=val_transform)
+
+    # The images are already decoded in shared memory, so no loader workers are needed
+    train_loader = DataLoader(train_dataset, batch_size=config['batch_size'], shuffle=True, num_workers=0)
+    val_loader = DataLoader(val_dataset, batch_size=config['batch_size'], shuffle=False, num_workers=0)
+
+    model = create_model(pretrained=True).to(cpu)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=config['lr'])
+
+    checkpoint_path = os.path.join(config['output_dir'], f'fold_{fold}.pth')
+    start = time.time()
+    best_acc = train_model(model, train_loader, val_loader, criterion, optimizer,
+                           num_epochs=config['epochs'], checkpoint_path=checkpoint_path, device=cpu)
+    train_time = time.time() - start
+
+    # Report metrics of the best checkpoint, not the last epoch
+    model.load_state_dict(torch.load(checkpoint_path, map_location=cpu))
+    metrics = evaluate_fold(model, val_loader)
+    metrics.update({
+        'fold': fold,
+        'best_val_acc': best_acc,
+        'train_size': len(train_indices),
+        'val_size': len(val_indices),
+        'train_time_s': train_time,
+        'checkpoint': checkpoint_path
+    })
+    return metrics
+
+def main():
+    parser = argparse.ArgumentParser(description='Stratified k-fold cross-validation of the CVI classifier')
+    parser.add_argument('--data-dir', default='data/CVI-img-datasets-2/imagedata')
+    parser.add_argument('--output-dir', default='models/checkpoints/cv')
+    parser.add_argument('--packed-cache', default='models/checkpoints/packed_224.pt',
+                        help='Decoded dataset cache shared by all folds (empty string to disable)')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--jobs', type=int, default=None, help='Folds trained concurrently (default: folds)')
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--augment-strength', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Decode every image once; the folds share this tensor through shared memory
+    images, labels = pack_dataset(args.data_dir, cache_path=args.packed_cache or None)
+    # Folds are built from whole near-duplicate clusters, stratified by grade,
+    # and leave out the manifest's held-out test split
+    entries = pack_entries(args.data_dir)
+    splits = stratified_kfold([entry['grade'] for entry in entries], k=args.folds, seed=args.seed,
+                              groups=[group_key(entry) for entry in entries],
+                              indices=[i for i, entry in enumerate(entries) if entry['split'] != 'test'])
+
+    # Download the pretrained weights once instead of racing from every worker
+    create_model(pretrained=True)
+
+    jobs = min(args.jobs or args.folds, args.folds)
+    num_threads = max(1, (os.cpu_count() or 1) // jobs)
+    print(f"Training {args.folds} folds, {jobs} at a time with {num_threads} CPU threads each")
+
+    config = {
+        'output_dir': args.output_dir,
+        'epochs': args.epochs,
+        'batch_size': args.batch_size,
+        'lr': args.lr,
+        'augment_strength': args.augment_strength,
+        'seed': args.seed
+    }
+
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=mp.get_context('spawn')) as executor:
+        futures = [
+            executor.submit(run_fold, fold, train_indices, val_indices, images, labels, config, num_threads)
+            for fold, (train_indices, val_indices) in enumerate(splits)
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            print(f"Fold {result['fold']}: Val Acc {result['accuracy']:.2f}% "
+                  f"({result['train_time_s']:.0f}s)")
+            results.append(result)
+
+    results.sort(key=lambda r: r['fold'])
+    accuracies = np.array([r['accuracy'] for r in results])
+    best = max(results, key=lambda r: r['accuracy'])
+
+    best_checkpoint = os.path.join(args.output_dir, 'cv_best_model.pth')
+    shutil.copyfile(best['checkpoint'], best_checkpoint)
+
+    summary = {
+        'config': config,
+        'folds': results,
+        'mean_accuracy': float(accuracies.mean()),
+        'std_accuracy': float(accuracies.std()),
+        'best_fold': best['fold'],
+        'best_checkpoint': best_checkpoint
+    }
+    report_path = os.path.join(args.output_dir, 'cv_results.json')
+    with open(report_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"\nCross-validation accuracy: {summary['mean_accuracy']:.2f}% "
+          f"+/- {summary['std_accuracy']:.2f}% over {args.folds} folds")
+    print(f"Best fold {best['fold']} ({best['accuracy']:.2f}%) saved to {best_checkpoint}")
+    print(f"Results saved to {report_path}")
+
+if __name__ == '__main__':
+    main()
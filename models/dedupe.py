@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+from collections import Counter, defaultdict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from architecture import DEFAULT_DESCRIPTOR, build_model, load_checkpoint
+from manifest import DatasetManifest
+from train import PackedDataset, pack_dataset, pack_entries, get_packed_transforms, device
+
+def embedding_model(checkpoint=None):
+    """Convolutional trunk of the CVI model, or of ImageNet MobileNetV2 if no checkpoint is given"""
+    if checkpoint:
+        model, descriptor = load_checkpoint(checkpoint, device)
+    else:
+        descriptor = DEFAULT_DESCRIPTOR
+        model = build_model(descriptor, pretrained=True).to(device).eval()
+    return model.features, descriptor['input_size']
+
+def extract_embeddings(features, images, labels, batch_size=64):
+    """L2-normalised global-average-pooled feature vectors of every packed image"""
+    _, val_transform = get_packed_transforms()
+    loader = DataLoader(PackedDataset(images, labels, transform=val_transform),
+                        batch_size=batch_size, shuffle=False, num_workers=0)
+    embeddings = []
+    with torch.no_grad():
+        for batch, _ in tqdm(loader, desc='Embedding images'):
+            pooled = F.adaptive_avg_pool2d(features(batch.to(device)), 1).flatten(1)
+            embeddings.append(F.normalize(pooled, dim=1).cpu())
+    return torch.cat(embeddings)
+
+def similar_pairs(embeddings, threshold, block_size=1024):
+    """
+    All pairs (i, j), i < j, with cosine similarity of at least threshold.
+
+    Compares one block of rows against every later image with a single matrix
+    product, so memory stays at block_size x N similarities.
+
+    Returns:
+        (pairs, similarities) with pairs an M x 2 array
+    """
+    pairs, similarities = [], []
+    n = len(embeddings)
+    for start in range(0, n, block_size):
+        block = embeddings[start:start + block_size]
+        sims = block @ embeddings[start:].T
+        # Keep only the upper triangle: pairs with j > i
+        sims = torch.triu(sims, diagonal=1)
+        rows, cols = torch.nonzero(sims >= threshold, as_tuple=True)
+        similarities.append(sims[rows, cols].numpy())
+        pairs.append(np.stack([rows.numpy() + start, cols.numpy() + start], axis=1))
+    return np.concatenate(pairs), np.concatenate(similarities)
+
+def find_clusters(n, pairs):
+    """Connected components of the similarity graph (union-find); only clusters of 2+ images"""
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    members = defaultdict(list)
+    for i in range(n):
+        members[find(i)].append(i)
+    return sorted((cluster for cluster in members.values() if len(cluster) > 1), key=lambda c: c[0])
+
+def main():
+    parser = argparse.ArgumentParser(description='Find near-duplicate images and group them in the dataset manifest')
+    parser.add_argument('--data-dir', default='data/CVI-img-datasets-2/imagedata')
+    parser.add_argument('--checkpoint', default=None,
+                        help='Embed with this CVI checkpoint instead of ImageNet MobileNetV2')
+    parser.add_argument('--threshold', type=float, default=0.95, help='Cosine similarity of near-duplicates')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--block-size', type=int, default=1024, help='Rows compared per similarity block')
+    parser.add_argument('--report', default='models/checkpoints/duplicates.json')
+    parser.add_argument('--dry-run', action='store_true', help='Report clusters without updating the manifest')
+    args = parser.parse_args()
+
+    features, input_size = embedding_model(args.checkpoint)
+    images, labels = pack_dataset(args.data_dir, size=input_size,
+                                  cache_path=f'models/checkpoints/packed_{input_size}.pt')
+    embeddings = extract_embeddings(features, images, labels, args.batch_size)
+
+    # Same order as pack_dataset, so entries[i] is the image of embeddings[i]
+    entries = pack_entries(args.data_dir)
+    manifest = DatasetManifest(args.data_dir)
+
+    pairs, similarities = similar_pairs(embeddings, args.threshold, args.block_size)
+    clusters = find_clusters(len(entries), pairs)
+    print(f"{len(pairs)} similar pairs, {len(clusters)} clusters covering "
+          f"{sum(len(c) for c in clusters)} of {len(entries)} images")
+
+    # Clusters whose images sit in different splits leak between training and validation
+    report_clusters = []
+    for cluster_id, cluster in enumerate(clusters):
+        members = [entries[i] for i in cluster]
+        report_clusters.append({
+            'cluster': cluster_id,
+            'size': len(members),
+            'paths': [entry['path'] for entry in members],
+            'grades': dict(Counter(entry['grade'] for entry in members)),
+            'splits': dict(Counter(entry['split'] for entry in members))
+        })
+    leaking = [c for c in report_clusters if len(c['splits']) > 1]
+    mixed_grades = [c for c in report_clusters if len(c['grades']) > 1]
+    print(f"{len(leaking)} clusters span more than one split, {len(mixed_grades)} have conflicting grades")
+
+    moved = 0
+    if not args.dry_run:
+        moved = manifest.set_clusters({entries[i]['path']: cluster_id
+                                       for cluster_id, cluster in enumerate(clusters) for i in cluster})
+        print(f"Manifest updated, {moved} images moved to their cluster's split")
+
+    report = {
+        'threshold': args.threshold,
+        'checkpoint': args.checkpoint,
+        'images': len(entries),
+        'similar_pairs': len(pairs),
+        'mean_pair_similarity': float(similarities.mean()) if len(similarities) else None,
+        'clusters': len(clusters),
+        'duplicate_images': sum(len(c) for c in clusters) - len(clusters),
+        'leaking_clusters': len(leaking),
+        'mixed_grade_clusters': len(mixed_grades),
+        'moved_images': moved,
+        'cluster_details': report_clusters
+    }
+    os.makedirs(os.path.dirname(args.report) or '.', exist_ok=True)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved to {args.report}")
+
+if __name__ == '__main__':
+    main()
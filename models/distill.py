@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from architecture import load_checkpoint, save_descriptor, count_parameters, measure_cpu_latency
+from train import PackedDataset, pack_dataset, split_indices, get_packed_transforms, create_model, device
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature, alpha):
+    """alpha * KL(teacher || student) on softened outputs + (1 - alpha) * cross-entropy on labels"""
+    soft_loss = F.kl_div(
+        F.log_softmax(student_logits / temperature, dim=1),
+        F.softmax(teacher_logits / temperature, dim=1),
+        reduction='batchmean'
+    ) * temperature ** 2  # Keep gradient magnitude independent of the temperature
+    hard_loss = F.cross_entropy(student_logits, labels)
+    return alpha * soft_loss + (1 - alpha) * hard_loss
+
+def evaluate(model, loader, input_size):
+    model.eval()
+    correct = 0
+    total = 0
+    with torch.no_grad():
+        for images, labels in loader:
+            images, labels = images.to(device), labels.to(device)
+            if images.shape[-1] != input_size:
+                images = F.interpolate(images, size=(input_size, input_size), mode='bilinear', align_corners=False)
+            _, predicted = model(images).max(1)
+            total += labels.size(0)
+            correct += predicted.eq(labels).sum().item()
+    return 100. * correct / total
+
+def train_student(student, teacher, descriptor, train_loader, val_loader, checkpoint_path,
+                  num_epochs=20, lr=0.001, temperature=4.0, alpha=0.7):
+    """Train a student on teacher soft targets plus labels, keeping the best checkpoint"""
+    optimizer = optim.Adam(student.parameters(), lr=lr)
+    input_size = descriptor['input_size']
+    best_acc = 0.0
+
+    for epoch in range(num_epochs):
+        student.train()
+        running_loss = 0.0
+        total = 0
+
+        pbar = tqdm(train_loader, desc=f'Epoch {epoch+1}/{num_epochs} [Distill]')
+        for images, labels in pbar:
+            images, labels = images.to(device), labels.to(device)
+
+            # The teacher always sees the full 224x224 input
+            with torch.no_grad():
+                teacher_logits = teacher(images)
+            if input_size != images.shape[-1]:
+                images = F.interpolate(images, size=(input_size, input_size), mode='bilinear', align_corners=False)
+
+            optimizer.zero_grad()
+            loss = distillation_loss(student(images), teacher_logits, labels, temperature, alpha)
+            loss.backward()
+            optimizer.step()
+
+            running_loss += loss.item() * labels.size(0)
+            total += labels.size(0)
+            pbar.set_postfix({'loss': running_loss/total})
+
+        val_acc = evaluate(student, val_loader, input_size)
+        print(f'Epoch {epoch+1} - Distill Loss: {running_loss/total:.4f}, Val Acc: {val_acc:.2f}%')
+
+        if val_acc > best_acc:
+            best_acc = val_acc
+            torch.save(student.state_dict(), checkpoint_path)
+            save_descriptor(checkpoint_path, descriptor)
+            print(f'New best student saved with validation accuracy: {best_acc:.2f}%')
+
+    return best_acc
+
+def main():
+    parser = argparse.ArgumentParser(description='Distill the CVI classifier into smaller MobileNetV2 students')
+    parser.add_argument('--data-dir', default='data/CVI-img-datasets-2/imagedata')
+    parser.add_argument('--teacher', default='models/checkpoints/best_model.pth')
+    parser.add_argument('--output-dir', default='models/checkpoints/students')
+    parser.add_argument('--widths', type=float, nargs='+', default=[0.35, 0.5, 0.75],
+                        help='MobileNetV2 width multipliers of the students')
+    parser.add_argument('--input-size', type=int, default=224,
+                        help='Student input resolution (the mobile apps expect 224)')
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--temperature', type=float, default=4.0)
+    parser.add_argument('--alpha', type=float, default=0.7, help='Weight of the soft-target loss')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    images, labels = pack_dataset(args.data_dir, cache_path='models/checkpoints/packed_224.pt')
+    train_indices = split_indices(args.data_dir, 'train')
+    val_indices = split_indices(args.data_dir, 'val')
+    train_transform, val_transform = get_packed_transforms()
+    train_loader = DataLoader(PackedDataset(images, labels, train_indices, transform=train_transform),
+                              batch_size=32, shuffle=True, num_workers=0)
+    val_loader = DataLoader(PackedDataset(images, labels, val_indices, transform=val_transform),
+                            batch_size=32, shuffle=False, num_workers=0)
+
+    teacher, teacher_descriptor = load_checkpoint(args.teacher, device)
+    report = [{
+        'name': 'teacher',
+        'checkpoint': args.teacher,
+        'descriptor': teacher_descriptor,
+        'parameters': count_parameters(teacher),
+        'val_accuracy': evaluate(teacher, val_loader, teacher_descriptor['input_size'])
+    }]
+
+    for width in args.widths:
+        torch.manual_seed(args.seed)
+        descriptor = {'arch': 'mobilenet_v2', 'width_mult': width, 'input_size': args.input_size}
+        checkpoint_path = os.path.join(args.output_dir, f'student_w{width}_{args.input_size}.pth')
+        print(f"\nDistilling student with width {width} at {args.input_size}x{args.input_size}")
+
+        student = create_model(pretrained=True, descriptor=descriptor).to(device)
+        best_acc = train_student(student, teacher, descriptor, train_loader, val_loader, checkpoint_path,
+                                 num_epochs=args.epochs, lr=args.lr,
+                                 temperature=args.temperature, alpha=args.alpha)
+        report.append({
+            'name': f'student_w{width}',
+            'checkpoint': checkpoint_path,
+            'descriptor': descriptor,
+            'parameters': count_parameters(student),
+            'val_accuracy': best_acc
+        })
+
+    # Latency of every model on CPU, measured after training so the runs do not overlap
+    for entry in report:
+        model, descriptor = load_checkpoint(entry['checkpoint'], 'cpu')
+        entry['cpu_latency_ms'] = measure_cpu_latency(model, descriptor['input_size'])
+
+    report_path = os.path.join(args.output_dir, 'distillation_report.json')
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\n{'Model':<16}{'Params':>12}{'Val Acc':>10}{'CPU ms':>10}")
+    for entry in report:
+        print(f"{entry['name']:<16}{entry['parameters']:>12,}{entry['val_accuracy']:>9.2f}%"
+              f"{entry['cpu_latency_ms']:>10.2f}")
+    print(f"Report saved to {report_path}")
+    print("Export a student with: python models/export_coreml.py <checkpoint> <output.mlpackage> "
+          "or python models/export_tflite.py <checkpoint> <output.tflite>")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import matplotlib.pyplot as plt
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from tqdm import tqdm
+
+from architecture import load_checkpoint, measure_cpu_latency
+from export_all import make_runner
+from manifest import DatasetManifest
+from train import CLASS_MAPPING, device
+
+CLASS_NAMES = ['normal', 'moderate', 'severe']
+
+# Exported artifacts that make_runner() can load, by file extension
+EXPORT_TARGETS = {'.pt': 'torchscript', '.onnx': 'onnx', '.tflite': 'tflite', '.mlpackage': 'coreml'}
+# Backends that accept a whole batch; the others run one image at a time
+BATCHED_TARGETS = ('torchscript', 'onnx')
+
+class Candidate:
+    """One model under evaluation: a checkpoint (with descriptor) or an exported artifact"""
+    def __init__(self, path, export_input_size=224):
+        self.path = path
+        self.name = os.path.relpath(path)
+        extension = os.path.splitext(path.rstrip('/'))[1]
+        self.target = EXPORT_TARGETS.get(extension, 'checkpoint')
+
+        if self.target == 'checkpoint':
+            self.model, descriptor = load_checkpoint(path, device)
+            self.input_size = descriptor['input_size']
+            self.arch = descriptor['arch']
+        else:
+            self.runner = make_runner(self.target, path)
+            self.input_size = export_input_size
+            self.arch = self.target
+
+        self.probs = []
+        self.inference_s = 0.0
+
+    def predict(self, batch):
+        """Softmax probabilities for a preprocessed batch at the candidate's input size"""
+        if batch.shape[-1] != self.input_size:
+            # The batch was preprocessed once at the largest input size;
+            # smaller models get an antialiased downscale of it
+            batch = F.interpolate(batch, size=(self.input_size, self.input_size),
+                                  mode='bilinear', align_corners=False, antialias=True)
+
+        start = time.perf_counter()
+        if self.target == 'checkpoint':
+            with torch.no_grad():
+                probs = torch.softmax(self.model(batch.to(device)), dim=1).cpu().numpy()
+        else:
+            x = batch.numpy()
+            if self.target in BATCHED_TARGETS:
+                probs = self.runner(x)
+            else:
+                probs = np.concatenate([self.runner(x[i:i + 1]) for i in range(len(x))])
+        self.inference_s += time.perf_counter() - start
+        self.probs.append(probs)
+
+    def cpu_latency_ms(self, runs=20):
+        """Median single-image CPU latency"""
+        if self.target == 'checkpoint':
+            return measure_cpu_latency(self.model, self.input_size, runs=runs)
+        x = np.random.rand(1, 3, self.input_size, self.input_size).astype(np.float32)
+        self.runner(x)
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            self.runner(x)
+            timings.append((time.perf_counter() - start) * 1000)
+        return float(np.median(timings))
+
+def expected_calibration_error(probs, labels, bins=15):
+    """ECE over equal-width confidence bins, with the per-bin data for reliability diagrams"""
+    confidence = probs.max(axis=1)
+    correct = probs.argmax(axis=1) == labels
+    edges = np.linspace(0, 1, bins + 1)
+    ece = 0.0
+    reliability = []
+    for low, high in zip(edges[:-1], edges[1:]):
+        in_bin = (confidence > low) & (confidence <= high)
+        if not in_bin.any():
+            continue
+        bin_confidence = float(confidence[in_bin].mean())
+        bin_accuracy = float(correct[in_bin].mean())
+        ece += in_bin.mean() * abs(bin_accuracy - bin_confidence)
+        reliability.append({'low': float(low), 'high': float(high), 'count': int(in_bin.sum()),
+                            'confidence': bin_confidence, 'accuracy': bin_accuracy})
+    return float(ece), reliability
+
+def classification_metrics(probs, labels, num_classes=len(CLASS_NAMES), bins=15):
+    """Accuracy, confusion matrix, per-class precision/recall/F1 and calibration"""
+    predictions = probs.argmax(axis=1)
+    confusion = np.zeros((num_classes, num_classes), dtype=int)
+    np.add.at(confusion, (labels, predictions), 1)
+
+    per_class = {}
+    for i, class_name in enumerate(CLASS_NAMES):
+        true_positives = confusion[i, i]
+        predicted = confusion[:, i].sum()
+        actual = confusion[i, :].sum()
+        precision = true_positives / predicted if predicted else 0.0
+        recall = true_positives / actual if actual else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        per_class[class_name] = {'precision': float(precision), 'recall': float(recall),
+                                 'f1': float(f1), 'support': int(actual)}
+
+    ece, reliability = expected_calibration_error(probs, labels, bins)
+    return {
+        'accuracy': float((predictions == labels).mean()),
+        'macro_f1': float(np.mean([metrics['f1'] for metrics in per_class.values()])),
+        'nll': float(-np.log(np.clip(probs[np.arange(len(labels)), labels], 1e-12, None)).mean()),
+        'ece': ece,
+        'confusion_matrix': confusion.tolist(),
+        'per_class': per_class,
+        'reliability': reliability
+    }
+
+def plot_confusion_matrices(results, output_path):
+    fig, axes = plt.subplots(1, len(results), figsize=(5 * len(results), 4.5), squeeze=False)
+    for ax, (name, result) in zip(axes[0], results.items()):
+        confusion = np.array(result['confusion_matrix'])
+        ax.imshow(confusion, cmap='Blues')
+        for (i, j), count in np.ndenumerate(confusion):
+            ax.text(j, i, str(count), ha='center', va='center',
+                    color='white' if count > confusion.max() / 2 else 'black')
+        ax.set_xticks(range(len(CLASS_NAMES)))
+        ax.set_xticklabels(CLASS_NAMES, rotation=45)
+        ax.set_yticks(range(len(CLASS_NAMES)))
+        ax.set_yticklabels(CLASS_NAMES)
+        ax.set_xlabel('Predicted')
+        ax.set_ylabel('True')
+        ax.set_title(f"{os.path.basename(name)}\nAcc {result['accuracy']*100:.1f}%, ECE {result['ece']:.3f}")
+    fig.tight_layout()
+    fig.savefig(output_path)
+    plt.close(fig)
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate several checkpoints or exported models in one dataset pass')
+    parser.add_argument('models', nargs='*', default=['models/checkpoints/best_model.pth'],
+                        help='Checkpoints (.pth with descriptor) or exported models (.pt, .onnx, .tflite, .mlpackage)')
+    parser.add_argument('--data-dir', default='data/CVI-img-datasets-2/imagedata')
+    parser.add_argument('--split', choices=['train', 'val', 'test', 'all'], default='test',
+                        help='Manifest split to evaluate on')
+    parser.add_argument('--export-input-size', type=int, default=224, help='Input size of exported models')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--bins', type=int, default=15, help='Confidence bins for the calibration error')
+    parser.add_argument('--latency-runs', type=int, default=20)
+    parser.add_argument('--output', default='models/checkpoints/evaluation.json')
+    parser.add_argument('--plot', default='models/evaluation_confusion.png')
+    args = parser.parse_args()
+
+    candidates = [Candidate(path, args.export_input_size) for path in args.models]
+    for candidate in candidates:
+        print(f"Loaded {candidate.name} ({candidate.arch}, {candidate.input_size}px)")
+
+    # Decode and preprocess every image once, at the largest input size
+    input_size = max(candidate.input_size for candidate in candidates)
+    transform = transforms.Compose([
+        transforms.Resize((input_size, input_size)),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+    manifest = DatasetManifest(args.data_dir)
+    manifest.update()
+    dataset = manifest.dataset(None if args.split == 'all' else args.split, CLASS_MAPPING, transform=transform)
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+    print(f"Evaluating {len(candidates)} models on {len(dataset)} images ({args.split} split)")
+
+    start = time.time()
+    for batch, _ in tqdm(loader, desc='Evaluating'):
+        for candidate in candidates:
+            candidate.predict(batch)
+    wall_time = time.time() - start
+    labels = np.array(dataset.labels)
+
+    results = {}
+    for candidate in candidates:
+        probs = np.concatenate(candidate.probs)
+        result = {'path': candidate.path, 'arch': candidate.arch, 'input_size': candidate.input_size}
+        result.update(classification_metrics(probs, labels, bins=args.bins))
+        result['throughput_ms_per_image'] = 1000 * candidate.inference_s / max(len(labels), 1)
+        result['cpu_latency_ms'] = candidate.cpu_latency_ms(args.latency_runs)
+        results[candidate.name] = result
+
+    print(f"\n{'Model':<40}{'Acc':>8}{'Macro F1':>10}{'ECE':>8}{'NLL':>8}{'CPU ms':>9}")
+    for name, result in results.items():
+        print(f"{name:<40}{result['accuracy']*100:>7.2f}%{result['macro_f1']:>10.3f}"
+              f"{result['ece']:>8.3f}{result['nll']:>8.3f}{result['cpu_latency_ms']:>9.2f}")
+    for name, result in results.items():
+        print(f"\n{name}")
+        for class_name, metrics in result['per_class'].items():
+            print(f"  {class_name:<10} precision {metrics['precision']:.3f}  recall {metrics['recall']:.3f}  "
+                  f"F1 {metrics['f1']:.3f}  (n={metrics['support']})")
+
+    report = {
+        'data_dir': args.data_dir,
+        'split': args.split,
+        'images': len(labels),
+        'preprocess_size': input_size,
+        'wall_time_s': wall_time,
+        'models': results
+    }
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    plot_confusion_matrices(results, args.plot)
+    print(f"\nReport saved to {args.output}, confusion matrices to {args.plot}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from PIL import Image
+from torchvision import transforms
+
+from architecture import load_checkpoint, descriptor_path
+
+# Bump when the export code changes in a way that invalidates cached artifacts
+# without changing TARGETS settings (e.g. a new tracing input or converter
+# option hard-coded in an export function)
+EXPORT_VERSION = 1
+
+# Export settings per target. They are passed to the export functions and are
+# part of the cache key, so changing one here re-exports that target. An ONNX
+# opset of None is the exporter's default for the installed torch.
+TARGETS = {
+    'torchscript': {'file': 'model.pt', 'settings': {}},
+    'onnx': {'file': 'model.onnx', 'settings': {'opset': None, 'dynamic_batch': True}},
+    'tflite': {'file': 'model.tflite', 'settings': {'float16': True}, 'requires': 'onnx'},
+    'coreml': {'file': 'model.mlpackage', 'settings': {'convert_to': 'neuralnetwork', 'target': 'iOS14'}}
+}
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def checkpoint_key(checkpoint_path):
+    """Hash of the checkpoint weights and its architecture descriptor"""
+    digest = hashlib.sha256(file_sha256(checkpoint_path).encode())
+    if os.path.exists(descriptor_path(checkpoint_path)):
+        digest.update(file_sha256(descriptor_path(checkpoint_path)).encode())
+    return digest.hexdigest()[:16]
+
+def target_key(target):
+    settings = json.dumps({'version': EXPORT_VERSION, **TARGETS[target]['settings']}, sort_keys=True)
+    return hashlib.sha256(settings.encode()).hexdigest()[:8]
+
+def artifact_path(cache_dir, target):
+    """Cached artifact location: <cache_dir>/<target>-<settings hash>/<file>"""
+    return os.path.join(cache_dir, f"{target}-{target_key(target)}", TARGETS[target]['file'])
+
+def export_target(target, checkpoint_path, output_path, dependency_path=None):
+    """Produce one artifact. Runs in a worker process, writing to a temporary path first."""
+    tmp_path = output_path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    start = time.time()
+    settings = TARGETS.get(target, {}).get('settings', {})
+
+    if target == 'torchscript':
+        model, descriptor = load_checkpoint(checkpoint_path, 'cpu')
+        size = descriptor['input_size']
+        traced = torch.jit.trace(model, torch.rand(1, 3, size, size))
+        traced.save(tmp_path)
+    elif target == 'onnx':
+        from export_tflite import export_onnx
+        model, descriptor = load_checkpoint(checkpoint_path, 'cpu')
+        export_onnx(model, descriptor['input_size'], tmp_path, opset=settings['opset'],
+                    dynamic_batch=settings['dynamic_batch'])
+    elif target == 'tflite':
+        from export_tflite import convert_onnx_to_tflite
+        convert_onnx_to_tflite(dependency_path, tmp_path, float16=settings['float16'])
+    elif target == 'coreml':
+        from export_coreml import convert_to_coreml
+        convert_to_coreml(checkpoint_path, tmp_path + '.mlpackage', convert_to=settings['convert_to'],
+                          target=settings['target'])
+        os.rename(tmp_path + '.mlpackage', tmp_path)
+    else:
+        raise ValueError(f"Unknown export target '{target}'")
+
+    # Only a completed export becomes visible in the cache
+    if os.path.isdir(output_path):
+        shutil.rmtree(output_path)
+    os.replace(tmp_path, output_path)
+    return target, time.time() - start
+
+def artifact_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+def load_samples(sample_paths, input_size):
+    """Preprocess sample images exactly like the API does"""
+    transform = transforms.Compose([
+        transforms.Resize((input_size, input_size)),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+    return torch.stack([transform(Image.open(path).convert('RGB')) for path in sample_paths])
+
+def softmax(logits):
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+def make_runner(target, path):
+    """Single-image probability function for an exported artifact"""
+    if target == 'torchscript':
+        model = torch.jit.load(path, map_location='cpu').eval()
+        def run(x):
+            with torch.no_grad():
+                return softmax(model(torch.from_numpy(x)).numpy())
+    elif target == 'onnx':
+        import onnxruntime
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        def run(x):
+            return softmax(session.run(None, {'input': x})[0])
+    elif target == 'tflite':
+        import tensorflow as tf
+        interpreter = tf.lite.Interpreter(model_path=path)
+        interpreter.allocate_tensors()
+        input_index = interpreter.get_input_details()[0]['index']
+        output_index = interpreter.get_output_details()[0]['index']
+        def run(x):
+            interpreter.set_tensor(input_index, x)
+            interpreter.invoke()
+            return softmax(interpreter.get_tensor(output_index))
+    elif target == 'coreml':
+        import coremltools as ct
+        mlmodel = ct.models.MLModel(path)
+        class_names = ['normal', 'moderate', 'severe']
+        def run(x):
+            outputs = mlmodel.predict({'input': x})
+            # The classifier returns a {class name: probability} dict next to the label
+            probs = next(value for value in outputs.values() if isinstance(value, dict))
+            return np.array([[probs[name] for name in class_names]])
+    return run
+
+def check_parity(target, path, samples, reference, max_prob_diff, latency_runs=20):
+    """
+    Compare an artifact's probabilities with PyTorch and time it on CPU.
+
+    Status is 'skipped' only when the backend cannot run on this machine (its
+    runtime is not installed, or CoreML off macOS), 'failed' when running the
+    artifact raises or its probabilities differ by more than max_prob_diff,
+    and 'ok' otherwise.
+    """
+    if target == 'coreml' and platform.system() != 'Darwin':
+        return {'status': 'skipped', 'reason': 'CoreML models only run on macOS'}
+    try:
+        run = make_runner(target, path)
+    except ImportError as e:
+        return {'status': 'skipped', 'reason': f"runtime not installed: {e}"}
+    except Exception as e:
+        return {'status': 'failed', 'reason': f"could not load the artifact: {type(e).__name__}: {e}"}
+
+    try:
+        probs = np.concatenate([run(samples[i:i + 1]) for i in range(len(samples))])
+        timings = []
+        for _ in range(latency_runs):
+            start = time.perf_counter()
+            run(samples[:1])
+            timings.append((time.perf_counter() - start) * 1000)
+    except Exception as e:
+        # The runtime is there, so this is a defect of the artifact (e.g. a wrong
+        # input name, shape or layout)
+        return {'status': 'failed', 'reason': f"{type(e).__name__}: {e}"}
+
+    diff = float(np.abs(probs - reference).max())
+    return {
+        'status': 'ok' if diff <= max_prob_diff else 'failed',
+        'reason': None if diff <= max_prob_diff else f"max probability difference {diff:.2e} > {max_prob_diff:.2e}",
+        'max_abs_prob_diff': diff,
+        'top1_agreement': float((probs.argmax(axis=1) == reference.argmax(axis=1)).mean()),
+        'cpu_latency_ms': float(np.median(timings))
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a checkpoint to every deployment format')
+    parser.add_argument('checkpoint', nargs='?', default='models/checkpoints/best_model.pth')
+    parser.add_argument('--targets', nargs='+', choices=sorted(TARGETS), default=sorted(TARGETS))
+    parser.add_argument('--cache-dir', default='models/exports')
+    parser.add_argument('--samples', nargs='*', default=['models/test_img.jpg'],
+                        help='Images used for the parity check')
+    parser.add_argument('--max-prob-diff', type=float, default=0.02,
+                        help='Largest probability difference from PyTorch a backend may have')
+    parser.add_argument('--jobs', type=int, default=3)
+    parser.add_argument('--force', action='store_true', help='Re-export even if cached')
+    parser.add_argument('--publish', action='store_true',
+                        help='Copy the TFLite and CoreML artifacts to models/cvi_model.*')
+    args = parser.parse_args()
+
+    cache_dir = os.path.join(args.cache_dir, checkpoint_key(args.checkpoint))
+    targets = list(args.targets)
+    # TFLite is converted from the ONNX artifact
+    if 'tflite' in targets and 'onnx' not in targets:
+        targets.append('onnx')
+    paths = {target: artifact_path(cache_dir, target) for target in targets}
+
+    todo = [t for t in targets if args.force or not os.path.exists(paths[t])]
+    for target in targets:
+        if target not in todo:
+            print(f"{target}: up to date ({paths[target]})")
+
+    # Independent targets run in parallel; dependent ones start once their input exists
+    if todo:
+        with ProcessPoolExecutor(max_workers=args.jobs, mp_context=mp.get_context('spawn')) as executor:
+            running = {}
+            waiting = list(todo)
+            while waiting or running:
+                for target in list(waiting):
+                    requires = TARGETS[target].get('requires')
+                    if requires in waiting or requires in running.values():
+                        continue
+                    waiting.remove(target)
+                    future = executor.submit(export_target, target, args.checkpoint, paths[target],
+                                             paths.get(requires))
+                    running[future] = target
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    target, seconds = future.result()
+                    del running[future]
+                    print(f"{target}: exported in {seconds:.1f}s ({paths[target]})")
+
+    # Parity harness: every backend against the PyTorch checkpoint on the same inputs
+    model, descriptor = load_checkpoint(args.checkpoint, 'cpu')
+    samples = load_samples(args.samples, descriptor['input_size'])
+    with torch.no_grad():
+        reference = torch.softmax(model(samples), dim=1).numpy()
+    samples = samples.numpy()
+
+    report = {'checkpoint': args.checkpoint, 'cache_dir': cache_dir, 'samples': args.samples, 'artifacts': {}}
+    print(f"\n{'Target':<12}{'Size (MB)':>10}{'Max diff':>12}{'Top-1':>8}{'CPU ms':>10}")
+    for target in args.targets:
+        entry = {'path': paths[target], 'size_bytes': artifact_size(paths[target])}
+        entry.update(check_parity(target, paths[target], samples, reference, args.max_prob_diff))
+        report['artifacts'][target] = entry
+        if 'max_abs_prob_diff' in entry:
+            print(f"{target:<12}{entry['size_bytes'] / 1e6:>10.2f}{entry['max_abs_prob_diff']:>12.2e}"
+                  f"{entry['top1_agreement'] * 100:>7.0f}%{entry['cpu_latency_ms']:>10.2f}"
+                  + ("" if entry['status'] == 'ok' else "  FAILED"))
+        else:
+            print(f"{target:<12}{entry['size_bytes'] / 1e6:>10.2f}  parity {entry['status']}: {entry['reason']}")
+
+    with open(os.path.join(cache_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved to {os.path.join(cache_dir, 'report.json')}")
+
+    failed = [target for target, entry in report['artifacts'].items() if entry['status'] == 'failed']
+    if failed:
+        # Never publish artifacts that disagree with the checkpoint
+        print(f"Parity check failed for {', '.join(failed)}")
+        sys.exit(1)
+
+    if args.publish:
+        published = {'tflite': 'models/cvi_model.tflite', 'coreml': 'models/cvi_model.mlpackage'}
+        for target, destination in published.items():
+            if target not in paths:
+                continue
+            if os.path.isdir(destination):
+                shutil.rmtree(destination)
+            if os.path.isdir(paths[target]):
+                shutil.copytree(paths[target], destination)
+            else:
+                shutil.copyfile(paths[target], destination)
+            print(f"Published {target} to {destination}")
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,18 @@
+import argparse
 import torch
-import torch.nn as nn
 import coremltools as ct
-from torchvision import models
 import numpy as np
 import os
+from architecture import load_checkpoint
 
-# Define the model architecture (same as in training)
-def create_model():
-    model = models.mobilenet_v2(weights=None)  # Updated from pretrained=False
-    model.classifier[1] = nn.Linear(model.last_channel, 3)  # 3 classes
-    return model
-
-def convert_to_coreml(model_path, output_path):
-    # Initialize the same model architecture as in training
-    model = models.mobilenet_v2(weights=None)
-    model.classifier[1] = torch.nn.Linear(model.last_channel, 3)  # 3 classes
-    
-    # Load the state dictionary
-    model.load_state_dict(torch.load(model_path, map_location='cpu'))
-    model.eval()
+def convert_to_coreml(model_path, output_path, convert_to="neuralnetwork", target="iOS14"):
+    # Rebuild the architecture recorded next to the checkpoint (stock MobileNetV2,
+    # distilled student, ...) and load the state dictionary
+    model, descriptor = load_checkpoint(model_path, 'cpu')
+    input_size = descriptor['input_size']
     
     # Create a sample input
-    example_input = torch.rand(1, 3, 224, 224)
+    example_input = torch.rand(1, 3, input_size, input_size)
     
     # Trace the model
     traced_model = torch.jit.trace(model, example_input)
@@ -31,8 +22,8 @@ def convert_to_coreml(model_path, output_path):
         traced_model,
         inputs=[ct.TensorType(name="input", shape=example_input.shape)],
         classifier_config=ct.ClassifierConfig(['normal', 'moderate', 'severe']),
-        convert_to="neuralnetwork",  # For older iOS compatibility
-        minimum_deployment_target=ct.target.iOS14  # Target iOS 14
+        convert_to=convert_to,  # neuralnetwork by default, for older iOS compatibility
+        minimum_deployment_target=getattr(ct.target, target)  # iOS 14 by default
     )
     
     # Save the model
@@ -40,4 +31,8 @@ def convert_to_coreml(model_path, output_path):
     print(f"Model exported to {output_path}")
 
 if __name__ == '__main__':
-    convert_to_coreml('models/checkpoints/best_model.pth', 'models/cvi_model.mlpackage') 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Export a checkpoint to CoreML')
+    parser.add_argument('checkpoint', nargs='?', default='models/checkpoints/best_model.pth')
+    parser.add_argument('output', nargs='?', default='models/cvi_model.mlpackage')
+    args = parser.parse_args()
+    convert_to_coreml(args.checkpoint, args.output)
@@ -1,55 +1,62 @@
 import torch
 import tensorflow as tf
 import numpy as np
-from torchvision import models, transforms
 from train import CVIDataset
+from architecture import load_checkpoint
+import argparse
+import os
+import tempfile
 
-def convert_to_tflite(model_path, output_path):
-    # Initialize the same model architecture as in training
-    model = models.mobilenet_v2(pretrained=False)
-    model.classifier[1] = torch.nn.Linear(model.last_channel, 3)  # 3 classes
-    
-    # Load the state dictionary
-    model.load_state_dict(torch.load(model_path, map_location='cpu'))
-    model.eval()
-    
-    # Create a sample input with the same preprocessing as validation
-    val_transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    ])
-    
-    # Create a sample input tensor with the correct dimensions
-    sample_input = torch.randn(1, 3, 224, 224)
-    
-    # Export to ONNX
-    torch.onnx.export(model, sample_input, 'temp_model.onnx',
+def export_onnx(model, input_size, output_path, opset=None, dynamic_batch=True):
+    """Export a PyTorch model to ONNX, by default with a dynamic batch dimension"""
+    sample_input = torch.randn(1, 3, input_size, input_size)
+    torch.onnx.export(model, sample_input, output_path,
                      input_names=['input'],
                      output_names=['output'],
+                     opset_version=opset,
                      dynamic_axes={'input': {0: 'batch_size'},
-                                 'output': {0: 'batch_size'}})
-    
-    # Convert ONNX to TensorFlow
+                                 'output': {0: 'batch_size'}} if dynamic_batch else None)
+
+def convert_onnx_to_tflite(onnx_path, output_path, float16=True):
+    """Convert an ONNX model to TFLite via a TensorFlow SavedModel in a temporary directory"""
     import onnx
     from onnx_tf.backend import prepare
     
-    onnx_model = onnx.load('temp_model.onnx')
-    tf_rep = prepare(onnx_model)
-    tf_rep.export_graph('tf_model')
-    
-    # Convert to TFLite
-    converter = tf.lite.TFLiteConverter.from_saved_model('tf_model')
-    converter.optimizations = [tf.lite.Optimize.DEFAULT]
-    converter.target_spec.supported_types = [tf.float16]
-    tflite_model = converter.convert()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Convert ONNX to TensorFlow
+        tf_model_dir = os.path.join(work_dir, 'tf_model')
+        tf_rep = prepare(onnx.load(onnx_path))
+        tf_rep.export_graph(tf_model_dir)
+        
+        # Convert to TFLite
+        converter = tf.lite.TFLiteConverter.from_saved_model(tf_model_dir)
+        if float16:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+        tflite_model = converter.convert()
     
     # Save TFLite model
     with open(output_path, 'wb') as f:
         f.write(tflite_model)
+
+def convert_to_tflite(model_path, output_path):
+    # Rebuild the architecture recorded next to the checkpoint (stock MobileNetV2,
+    # distilled student, ...) and load the state dictionary
+    model, descriptor = load_checkpoint(model_path, 'cpu')
+    input_size = descriptor['input_size']
+    
+    # Export to ONNX and convert, keeping intermediates out of the working directory
+    with tempfile.TemporaryDirectory() as work_dir:
+        onnx_path = os.path.join(work_dir, 'model.onnx')
+        export_onnx(model, input_size, onnx_path)
+        convert_onnx_to_tflite(onnx_path, output_path)
     
     print(f"Model exported to {output_path}")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a checkpoint to TFLite')
     # Use the same path as in train.py for the best model
-    convert_to_tflite('models/checkpoints/best_model.pth', 'models/cvi_model.tflite') 
\ No newline at end of file
+    parser.add_argument('checkpoint', nargs='?', default='models/checkpoints/best_model.pth')
+    parser.add_argument('output', nargs='?', default='models/cvi_model.tflite')
+    args = parser.parse_args()
+    convert_to_tflite(args.checkpoint, args.output)
@@ -0,0 +1,316 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+from collections import Counter, defaultdict
+
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, Sampler
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = '.cvi_manifest.json'
+IMAGE_EXTENSION = '.bmp'
+SPLIT_RATIOS = {'train': 0.8, 'val': 0.1, 'test': 0.1}
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class DatasetManifest:
+    """
+    Persistent index of the CVI image tree (<data_dir>/<grade>/<image>.bmp).
+
+    Each entry records the image path relative to data_dir, its file size and
+    mtime, the grade folder it came from (the label; datasets map grades to
+    classes), an optional content hash and a stratified train/val/test split.
+    Loading the index replaces walking the tree; update() only re-lists grade
+    folders whose mtime changed.
+
+    Entries may also carry a near-duplicate cluster id (written by
+    models/dedupe.py). All images of a cluster are kept in the same split.
+    """
+    def __init__(self, data_dir, index_path=None, split_ratios=SPLIT_RATIOS, seed=42):
+        self.data_dir = data_dir
+        self.index_path = index_path or os.path.join(data_dir, MANIFEST_NAME)
+        self.split_ratios = dict(split_ratios)
+        self.seed = seed
+        self.dir_mtimes = {}
+        self.entries = {}
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index.get('version') == MANIFEST_VERSION:
+                self.split_ratios = index['split_ratios']
+                self.seed = index['seed']
+                self.dir_mtimes = index['dir_mtimes']
+                self.entries = {entry['path']: entry for entry in index['entries']}
+
+    def save(self):
+        index = {
+            'version': MANIFEST_VERSION,
+            'split_ratios': self.split_ratios,
+            'seed': self.seed,
+            'dir_mtimes': self.dir_mtimes,
+            'entries': sorted(self.entries.values(), key=lambda entry: entry['path'])
+        }
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def update(self, full=False, compute_hash=False):
+        """
+        Bring the index up to date with the tree and save it if anything changed.
+
+        Args:
+            full: Re-stat every file, also in folders whose mtime did not change
+                  (catches images overwritten in place)
+            compute_hash: Store a SHA-1 of new or changed files
+
+        Returns:
+            Number of entries added, changed or removed
+        """
+        changes = 0
+        grades = sorted(name for name in os.listdir(self.data_dir)
+                        if name.isdigit() and os.path.isdir(os.path.join(self.data_dir, name)))
+
+        # Drop entries of grade folders that no longer exist
+        for path, entry in list(self.entries.items()):
+            if entry['grade'] not in grades:
+                del self.entries[path]
+                changes += 1
+        for grade in list(self.dir_mtimes):
+            if grade not in grades:
+                del self.dir_mtimes[grade]
+
+        for grade in grades:
+            grade_dir = os.path.join(self.data_dir, grade)
+            dir_mtime = os.stat(grade_dir).st_mtime
+            # Adding, removing or renaming a file changes the folder's mtime
+            if not full and self.dir_mtimes.get(grade) == dir_mtime:
+                continue
+
+            seen = set()
+            with os.scandir(grade_dir) as it:
+                for item in it:
+                    if not item.name.endswith(IMAGE_EXTENSION) or not item.is_file():
+                        continue
+                    path = f"{grade}/{item.name}"
+                    seen.add(path)
+                    stat = item.stat()
+                    entry = self.entries.get(path)
+                    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                        if compute_hash and not entry.get('hash'):
+                            entry['hash'] = file_hash(item.path)
+                            changes += 1
+                        continue
+
+                    entry = entry or {'path': path, 'grade': grade, 'split': None}
+                    entry.update({'size': stat.st_size, 'mtime': stat.st_mtime,
+                                  'hash': file_hash(item.path) if compute_hash else None})
+                    self.entries[path] = entry
+                    changes += 1
+
+            for path in [p for p, e in self.entries.items() if e['grade'] == grade and p not in seen]:
+                del self.entries[path]
+                changes += 1
+            self.dir_mtimes[grade] = dir_mtime
+
+        changes += self.assign_splits()
+        if changes or not os.path.exists(self.index_path):
+            self.save()
+        return changes
+
+    def assign_splits(self, reassign=False):
+        """
+        Give every entry without a split (or all entries if reassign) a split,
+        stratified by grade.
+
+        Existing assignments are kept so that new images never move old ones
+        between train and validation. Images of the same near-duplicate cluster
+        are assigned together: a new image joins the split its cluster already
+        has, and an unassigned cluster goes to the split that is furthest below
+        its target share for the cluster's grade.
+
+        Returns:
+            Number of entries assigned
+        """
+        if reassign:
+            for entry in self.entries.values():
+                entry['split'] = None
+
+        groups = defaultdict(list)
+        for entry in self.entries.values():
+            groups[group_key(entry)].append(entry)
+
+        assigned = 0
+        by_grade = defaultdict(list)
+        for members in groups.values():
+            splits = Counter(entry['split'] for entry in members if entry['split'])
+            if splits:
+                split = splits.most_common(1)[0][0]
+                for entry in members:
+                    if not entry['split']:
+                        entry['split'] = split
+                        assigned += 1
+            else:
+                # A cluster is stratified by the grade most of its images have
+                grade = Counter(entry['grade'] for entry in members).most_common(1)[0][0]
+                by_grade[grade].append(members)
+
+        counts = defaultdict(Counter)
+        for entry in self.entries.values():
+            if entry['split']:
+                counts[entry['grade']][entry['split']] += 1
+
+        rng = random.Random(self.seed)
+        for grade in sorted(by_grade):
+            new_groups = sorted(by_grade[grade], key=lambda members: min(entry['path'] for entry in members))
+            rng.shuffle(new_groups)
+            grade_counts = counts[grade]
+            for members in new_groups:
+                total = sum(grade_counts.values()) + len(members)
+                split = max(self.split_ratios,
+                            key=lambda split: self.split_ratios[split] * total - grade_counts[split])
+                for entry in members:
+                    entry['split'] = split
+                grade_counts[split] += len(members)
+                assigned += len(members)
+        return assigned
+
+    def set_clusters(self, clusters):
+        """
+        Record near-duplicate clusters and move images so no cluster spans two
+        splits.
+
+        Args:
+            clusters: Dict mapping image path (relative to data_dir) to a cluster
+                      id; images not in it become singletons
+
+        Returns:
+            Number of entries whose split changed
+        """
+        for path, entry in self.entries.items():
+            entry['cluster'] = clusters.get(path)
+
+        groups = defaultdict(list)
+        for entry in self.entries.values():
+            groups[group_key(entry)].append(entry)
+
+        # A split cluster moves to the split that holds most of its images;
+        # ties go to the split listed first (train)
+        order = list(self.split_ratios)
+        moved = 0
+        for members in groups.values():
+            splits = Counter(entry['split'] for entry in members if entry['split'])
+            if len(splits) < 2:
+                continue
+            split = max(splits, key=lambda split: (splits[split], -order.index(split)))
+            for entry in members:
+                if entry['split'] and entry['split'] != split:
+                    entry['split'] = split
+                    moved += 1
+
+        self.assign_splits()
+        self.save()
+        return moved
+
+    def select(self, split=None):
+        """Entries of one split (all entries if split is None), sorted by path"""
+        return sorted((entry for entry in self.entries.values() if split is None or entry['split'] == split),
+                      key=lambda entry: entry['path'])
+
+    def dataset(self, split, class_mapping, transform=None, return_paths=False):
+        """Dataset view over one split with its own transform"""
+        return ManifestDataset(self.data_dir, self.select(split), class_mapping, transform, return_paths)
+
+def group_key(entry):
+    """Near-duplicate cluster of an entry; images without a cluster are their own group"""
+    return ('cluster', entry['cluster']) if entry.get('cluster') is not None else ('path', entry['path'])
+
+class ManifestDataset(Dataset):
+    """Images of a DatasetManifest, labelled by mapping grade folders to classes"""
+    def __init__(self, data_dir, entries, class_mapping, transform=None, return_paths=False):
+        entries = [entry for entry in entries if entry['grade'] in class_mapping]
+        self.images = [os.path.join(data_dir, entry['path']) for entry in entries]
+        self.labels = [class_mapping[entry['grade']] for entry in entries]
+        self.groups = [group_key(entry) for entry in entries]
+        self.transform = transform
+        self.return_paths = return_paths
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        img_path = self.images[idx]
+        label = self.labels[idx]
+
+        image = Image.open(img_path).convert('RGB')
+        if self.transform:
+            image = self.transform(image)
+
+        if self.return_paths:
+            return image, label, img_path
+        return image, label
+
+class ClusterSampler(Sampler):
+    """
+    Draws one random image per near-duplicate cluster each epoch.
+
+    An epoch then has one sample per distinct image instead of one per shot, and
+    successive epochs still see the different shots of a cluster.
+
+    Args:
+        groups: Group of every dataset item, e.g. ManifestDataset.groups
+    """
+    def __init__(self, groups, seed=None):
+        members = defaultdict(list)
+        for idx, group in enumerate(groups):
+            members[group].append(idx)
+        self.clusters = list(members.values())
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def __iter__(self):
+        for c in torch.randperm(len(self.clusters), generator=self.generator).tolist():
+            cluster = self.clusters[c]
+            yield cluster[torch.randint(len(cluster), (1,), generator=self.generator).item()]
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or refresh the dataset manifest')
+    parser.add_argument('data_dir', nargs='?', default='data/CVI-img-datasets-2/imagedata')
+    parser.add_argument('--full', action='store_true', help='Re-stat every file, not only changed folders')
+    parser.add_argument('--hash', action='store_true', help='Store content hashes')
+    parser.add_argument('--resplit', action='store_true', help='Discard and redraw all split assignments')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for a --resplit')
+    args = parser.parse_args()
+
+    manifest = DatasetManifest(args.data_dir)
+    if args.resplit:
+        if args.seed is not None:
+            manifest.seed = args.seed
+        manifest.assign_splits(reassign=True)
+    changes = manifest.update(full=args.full or args.resplit, compute_hash=args.hash)
+    if args.resplit:
+        manifest.save()
+
+    clusters = len({entry['cluster'] for entry in manifest.entries.values() if entry.get('cluster') is not None})
+    print(f"Manifest {manifest.index_path}: {len(manifest.entries)} images, {changes} changes, "
+          f"{clusters} near-duplicate clusters")
+    for split in manifest.split_ratios:
+        grades = Counter(entry['grade'] for entry in manifest.select(split))
+        print(f"  {split}: {sum(grades.values())} images " +
+              ", ".join(f"grade {grade}: {count}" for grade, count in sorted(grades.items())))
+
+if __name__ == '__main__':
+    main()
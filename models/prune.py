@@ -0,0 +1,126 @@
+import argparse
+import math
+import os
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader
+
+from architecture import (descriptor_path, load_checkpoint, save_descriptor, expanding_blocks, prune_mobilenet_v2,
+                          count_flops, count_parameters, measure_cpu_latency)
+from train import PackedDataset, pack_dataset, split_indices, get_packed_transforms, train_model, device
+
+def channels_to_keep(bn, fraction, multiple=8):
+    """
+    Rank the channels behind a BatchNorm layer by |gamma| and keep the strongest.
+
+    The kept count is rounded up to a multiple of `multiple`, which keeps the
+    convolutions fast on CPU and mobile kernels.
+    """
+    channels = bn.weight.numel()
+    keep_count = int(math.ceil(channels * (1 - fraction) / multiple) * multiple)
+    keep_count = max(multiple, min(channels, keep_count))
+    ranked = torch.argsort(bn.weight.detach().abs(), descending=True)[:keep_count]
+    return sorted(ranked.tolist())
+
+def prune_step(model, fraction):
+    """Remove `fraction` of the channels of every expansion layer and of last_channel"""
+    hidden_keep = [channels_to_keep(block.conv[0][1], fraction) for block in expanding_blocks(model)]
+    last_keep = channels_to_keep(model.features[-1][1], fraction)
+    prune_mobilenet_v2(model, hidden_keep, last_keep)
+    return model
+
+def describe(model, descriptor):
+    """Architecture descriptor for a pruned MobileNetV2"""
+    return {
+        'arch': 'pruned_mobilenet_v2',
+        'width_mult': descriptor.get('width_mult', 1.0),
+        'input_size': descriptor['input_size'],
+        'hidden_channels': [block.conv[0][0].out_channels for block in expanding_blocks(model)],
+        'last_channel': model.classifier[1].in_features
+    }
+
+def profile(model, input_size):
+    """FLOPs, parameters and CPU latency; leaves the model on `device`"""
+    stats = {
+        'mflops': count_flops(model, input_size) / 1e6,
+        'parameters': count_parameters(model),
+        'cpu_latency_ms': measure_cpu_latency(model, input_size)
+    }
+    model.to(device)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Structured channel pruning of the CVI MobileNetV2')
+    parser.add_argument('--data-dir', default='data/CVI-img-datasets-2/imagedata')
+    parser.add_argument('--checkpoint', default='models/checkpoints/best_model.pth')
+    parser.add_argument('--output', default='models/checkpoints/pruned_model.pth')
+    parser.add_argument('--target-fraction', type=float, default=0.5,
+                        help='Fraction of the original channels to remove in total')
+    parser.add_argument('--target-latency-ms', type=float, default=None,
+                        help='Stop pruning once CPU latency is at or below this')
+    parser.add_argument('--steps', type=int, default=3, help='Prune/fine-tune rounds')
+    parser.add_argument('--finetune-epochs', type=int, default=3)
+    parser.add_argument('--lr', type=float, default=0.0005)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    model, descriptor = load_checkpoint(args.checkpoint, device)
+    if descriptor['arch'] not in ('mobilenet_v2', 'pruned_mobilenet_v2'):
+        raise ValueError(f"Pruning supports MobileNetV2 checkpoints, got '{descriptor['arch']}'")
+    input_size = descriptor['input_size']
+
+    images, labels = pack_dataset(args.data_dir, size=input_size,
+                                  cache_path=f'models/checkpoints/packed_{input_size}.pt')
+    train_indices = split_indices(args.data_dir, 'train')
+    val_indices = split_indices(args.data_dir, 'val')
+    train_transform, val_transform = get_packed_transforms()
+    train_loader = DataLoader(PackedDataset(images, labels, train_indices, transform=train_transform),
+                              batch_size=32, shuffle=True, num_workers=0)
+    val_loader = DataLoader(PackedDataset(images, labels, val_indices, transform=val_transform),
+                            batch_size=32, shuffle=False, num_workers=0)
+
+    baseline = profile(model, input_size)
+    print(f"Baseline: {baseline['mflops']:.1f} MFLOPs, {baseline['parameters']:,} params, "
+          f"{baseline['cpu_latency_ms']:.2f} ms")
+
+    # Remove the same fraction of the remaining channels at every step so the
+    # total reaches target_fraction after the last one
+    step_fraction = 1 - (1 - args.target_fraction) ** (1 / args.steps)
+    criterion = nn.CrossEntropyLoss()
+    torch.manual_seed(args.seed)
+
+    step_path = os.path.splitext(args.output)[0] + '.step.pth'
+    for step in range(args.steps):
+        prune_step(model, step_fraction)
+        model = model.to(device)
+        pruned_descriptor = describe(model, descriptor)
+        stats = profile(model, input_size)
+        print(f"\nStep {step+1}/{args.steps}: {stats['mflops']:.1f} MFLOPs, {stats['parameters']:,} params, "
+              f"{stats['cpu_latency_ms']:.2f} ms")
+
+        # Fine-tune to recover accuracy; train_model keeps the best epoch in a
+        # step checkpoint, which replaces the output together with its
+        # descriptor so the weights and architecture at args.output always match
+        optimizer = optim.Adam(model.parameters(), lr=args.lr)
+        best_acc = train_model(model, train_loader, val_loader, criterion, optimizer,
+                               num_epochs=args.finetune_epochs, checkpoint_path=step_path)
+        save_descriptor(step_path, pruned_descriptor)
+        os.replace(descriptor_path(step_path), descriptor_path(args.output))
+        os.replace(step_path, args.output)
+        model, _ = load_checkpoint(args.output, device)
+        print(f"Step {step+1} recovered validation accuracy: {best_acc:.2f}%")
+
+        if args.target_latency_ms is not None and stats['cpu_latency_ms'] <= args.target_latency_ms:
+            print(f"Reached target latency of {args.target_latency_ms:.2f} ms")
+            break
+
+    final = profile(model, input_size)
+    print(f"\nPruned model saved to {args.output} with descriptor {os.path.splitext(args.output)[0]}.json")
+    print(f"FLOPs: {baseline['mflops']:.1f} -> {final['mflops']:.1f} MFLOPs, "
+          f"params: {baseline['parameters']:,} -> {final['parameters']:,}, "
+          f"CPU latency: {baseline['cpu_latency_ms']:.2f} -> {final['cpu_latency_ms']:.2f} ms")
+
+if __name__ == '__main__':
+    main()
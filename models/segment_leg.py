@@ -2,16 +2,30 @@ import cv2
 import numpy as np
 from PIL import Image
 import os
-import matplotlib.pyplot as plt
+import logging
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-def segment_leg(image_path, output_path=None, visualize_seeds=True):
+# Per-image progress goes to this logger instead of stdout so bulk runs can
+# aggregate it; the __main__ block below enables INFO output
+logger = logging.getLogger(__name__)
+
+def segment_leg(image_path, output_path=None, visualize_seeds=True, details=None,
+                collect_intermediates=False):
     """
     Leg segmentation using multiple seed points for flood fill to preserve CVI symptoms.
     
     Args:
         image_path: Path to the input image
         output_path: Path to save the processed image (if None, returns the image without saving)
-        visualize_seeds: Whether to visualize and save the seed points
+        visualize_seeds: Whether to render the debug visualizations next to the input
+                         image (see render_debug_artifacts)
+        details: Optional dict that is filled with the segmentation method used
+                 ('multi_seed', 'background_fill', 'bounding_box' or 'none') and
+                 the binary leg mask in input image coordinates
+        collect_intermediates: Also store the intermediate masks and seed points in
+                               details['intermediates'], so the debug visualizations
+                               can be rendered later
         
     Returns:
         PIL Image object with the processed leg
@@ -54,23 +68,33 @@ def segment_leg(image_path, output_path=None, visualize_seeds=True):
     flood_fill_flags |= cv2.FLOODFILL_FIXED_RANGE
     flood_fill_flags |= (255 << 8)  # Fill with white
     
+    # Intermediate results for the debug visualizations
+    intermediates = {'image': img_rgb, 'skin_mask': skin_mask, 'seed_points': []}
+    if collect_intermediates and details is not None:
+        details['intermediates'] = intermediates
+    
+    def finish(pil_image):
+        # Render the debug visualizations for whichever method produced the result
+        if visualize_seeds:
+            render_debug_artifacts(intermediates, pil_image, os.path.dirname(image_path),
+                                   os.path.splitext(os.path.basename(image_path))[0])
+        return pil_image
+    
     # Find all skin pixels to use as seed points
     y_indices, x_indices = np.where(skin_mask > 0)
     
     # If no skin pixels found, use fallback method
     if len(y_indices) == 0:
-        print("No skin pixels detected, using fallback method")
-        return background_flood_fill(img, output_path)
+        logger.debug("No skin pixels detected, using fallback method")
+        return finish(background_flood_fill(img, output_path, details))
     
     # Sample seed points (use a subset to avoid too many flood fills)
     num_seeds = min(50, len(y_indices))
     step = len(y_indices) // num_seeds
     
-    print(f"Using {num_seeds} seed points for flood fill")
+    logger.debug(f"Using {num_seeds} seed points for flood fill")
     
-    # Create a copy of the original image to visualize seed points
-    seed_visualization = img_rgb.copy()
-    seed_points = []
+    seed_points = intermediates['seed_points']
     
     # Use each seed point for flood fill
     for i in range(0, len(y_indices), step):
@@ -103,24 +127,6 @@ def segment_leg(image_path, output_path=None, visualize_seeds=True):
         # Add this flood fill result to the combined result
         flood_img = cv2.bitwise_or(flood_img, cv2.cvtColor(temp_mask, cv2.COLOR_GRAY2BGR))
     
-    # Visualize seed points if requested
-    if visualize_seeds:
-        # Draw seed points on the image
-        for x, y in seed_points:
-            cv2.circle(seed_visualization, (x, y), 3, (255, 0, 0), -1)
-        
-        # Save the seed point visualization
-        seed_vis_path = os.path.join(os.path.dirname(image_path), 
-                                    f"{os.path.splitext(os.path.basename(image_path))[0]}_seeds.jpg")
-        Image.fromarray(seed_visualization).save(seed_vis_path)
-        print(f"Seed point visualization saved to {seed_vis_path}")
-        
-        # Also create a visualization of the skin mask
-        skin_mask_vis_path = os.path.join(os.path.dirname(image_path), 
-                                         f"{os.path.splitext(os.path.basename(image_path))[0]}_skin_mask.jpg")
-        Image.fromarray(skin_mask).save(skin_mask_vis_path)
-        print(f"Skin mask visualization saved to {skin_mask_vis_path}")
-    
     # Convert combined flood fill result to grayscale
     flood_gray = cv2.cvtColor(flood_img, cv2.COLOR_BGR2GRAY)
     
@@ -129,8 +135,8 @@ def segment_leg(image_path, output_path=None, visualize_seeds=True):
     
     # If no significant contours found, try a different approach
     if not contours or max(cv2.contourArea(c) for c in contours) < (h*w*0.05):
-        print("Multi-seed flood fill didn't work well, trying background flood fill")
-        return background_flood_fill(img, output_path)
+        logger.debug("Multi-seed flood fill didn't work well, trying background flood fill")
+        return finish(background_flood_fill(img, output_path, details))
     
     # Find the largest contour (the leg)
     largest_contour = max(contours, key=cv2.contourArea)
@@ -140,7 +146,7 @@ def segment_leg(image_path, output_path=None, visualize_seeds=True):
     cv2.drawContours(clean_mask, [largest_contour], 0, 255, -1)
     
     # Save the clean mask from flood fill for visualization
-    flood_fill_mask = clean_mask.copy()
+    intermediates['flood_fill_mask'] = clean_mask.copy()
     
     # Create a convex hull of the largest contour
     hull = cv2.convexHull(largest_contour)
@@ -148,6 +154,7 @@ def segment_leg(image_path, output_path=None, visualize_seeds=True):
     # Create a mask with the convex hull
     convex_mask = np.zeros_like(flood_gray)
     cv2.drawContours(convex_mask, [hull], 0, 255, -1)
+    intermediates['convex_mask'] = convex_mask
     
     # Use a more conservative approach: dilate the flood fill mask slightly
     # This will fill small gaps but preserve the overall shape better than a full convex hull
@@ -174,66 +181,84 @@ def segment_leg(image_path, output_path=None, visualize_seeds=True):
     background = cv2.bitwise_and(black_bg, black_bg, mask=inv_mask)
     final_result = cv2.add(result, background)
     
-    # If visualize_seeds is True, create a comprehensive visualization
-    if visualize_seeds:
-        # Create a figure with multiple subplots
-        plt.figure(figsize=(15, 10))
-        
-        # Original image
-        plt.subplot(2, 3, 1)
-        plt.imshow(img_rgb)
-        plt.title('Original Image')
-        plt.axis('off')
-        
-        # Skin mask
-        plt.subplot(2, 3, 2)
-        plt.imshow(skin_mask, cmap='gray')
-        plt.title('Skin Mask')
-        plt.axis('off')
-        
-        # Seed points
-        plt.subplot(2, 3, 3)
-        plt.imshow(seed_visualization)
-        plt.title(f'Seed Points ({len(seed_points)})')
-        plt.axis('off')
-        
-        # Flood fill result
-        plt.subplot(2, 3, 4)
-        plt.imshow(flood_fill_mask, cmap='gray')
-        plt.title('Flood Fill Result')
-        plt.axis('off')
-        
-        # Convex hull mask
-        plt.subplot(2, 3, 5)
-        plt.imshow(convex_mask, cmap='gray')
-        plt.title('Convex Hull')
-        plt.axis('off')
-        
-        # Final result
-        plt.subplot(2, 3, 6)
-        plt.imshow(final_result)
-        plt.title('Final Result')
-        plt.axis('off')
-        
-        # Save the comprehensive visualization
-        vis_path = os.path.join(os.path.dirname(image_path), 
-                               f"{os.path.splitext(os.path.basename(image_path))[0]}_visualization.jpg")
-        plt.tight_layout()
-        plt.savefig(vis_path)
-        plt.close()
-        print(f"Comprehensive visualization saved to {vis_path}")
-    
     # Convert to PIL Image
     pil_image = Image.fromarray(final_result)
     
     # Save if output path is provided
     if output_path:
         pil_image.save(output_path)
-        print(f"Processed image saved to {output_path}")
+        logger.info(f"Processed image saved to {output_path}")
     
-    return pil_image
+    if details is not None:
+        details['method'] = 'multi_seed'
+        details['mask'] = final_mask
+    
+    return finish(pil_image)
 
-def background_flood_fill(img, output_path=None):
+def render_debug_figure(intermediates, result):
+    """
+    Six-panel figure of the segmentation steps: original image, skin mask, seed
+    points, flood fill result, convex hull and final result.
+    
+    Uses the object-oriented Matplotlib API on an Agg canvas, so it can run in a
+    background thread. Steps that were not reached (the fallback methods) are
+    left empty.
+    """
+    fig = Figure(figsize=(15, 10))
+    FigureCanvasAgg(fig)
+    panels = [
+        ('Original Image', intermediates.get('image'), None),
+        ('Skin Mask', intermediates.get('skin_mask'), 'gray'),
+        (f"Seed Points ({len(intermediates.get('seed_points', []))})", draw_seed_points(intermediates), None),
+        ('Flood Fill Result', intermediates.get('flood_fill_mask'), 'gray'),
+        ('Convex Hull', intermediates.get('convex_mask'), 'gray'),
+        ('Final Result', np.array(result), None)
+    ]
+    for i, (title, image, cmap) in enumerate(panels):
+        ax = fig.add_subplot(2, 3, i + 1)
+        if image is not None:
+            ax.imshow(image, cmap=cmap)
+        else:
+            title += ' (not reached)'
+        ax.set_title(title)
+        ax.axis('off')
+    fig.tight_layout()
+    return fig
+
+def draw_seed_points(intermediates):
+    """Copy of the input image with the flood fill seed points drawn on it"""
+    seed_visualization = intermediates['image'].copy()
+    for x, y in intermediates.get('seed_points', []):
+        cv2.circle(seed_visualization, (int(x), int(y)), 3, (255, 0, 0), -1)
+    return seed_visualization
+
+def render_debug_artifacts(intermediates, result, output_dir, stem):
+    """
+    Write the seed point image, the skin mask and the six-panel visualization
+    (<stem>_seeds.jpg, <stem>_skin_mask.jpg, <stem>_visualization.jpg) to output_dir.
+    
+    Args:
+        intermediates: details['intermediates'] of a segment_leg call
+        result: The segmented PIL image returned by segment_leg
+    
+    Returns:
+        List of the written paths
+    """
+    seed_vis_path = os.path.join(output_dir, f"{stem}_seeds.jpg")
+    Image.fromarray(draw_seed_points(intermediates)).save(seed_vis_path)
+    logger.info(f"Seed point visualization saved to {seed_vis_path}")
+    
+    skin_mask_vis_path = os.path.join(output_dir, f"{stem}_skin_mask.jpg")
+    Image.fromarray(intermediates['skin_mask']).save(skin_mask_vis_path)
+    logger.info(f"Skin mask visualization saved to {skin_mask_vis_path}")
+    
+    vis_path = os.path.join(output_dir, f"{stem}_visualization.jpg")
+    render_debug_figure(intermediates, result).savefig(vis_path)
+    logger.info(f"Comprehensive visualization saved to {vis_path}")
+    
+    return [seed_vis_path, skin_mask_vis_path, vis_path]
+
+def background_flood_fill(img, output_path=None, details=None):
     """Alternative approach using background flood fill"""
     img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     h, w = img.shape[:2]
@@ -269,8 +294,8 @@ def background_flood_fill(img, output_path=None):
     
     # If no significant contours found, use bounding box approach
     if not contours or max(cv2.contourArea(c) for c in contours) < (h*w*0.1):
-        print("Background flood fill didn't work well, using bounding box approach")
-        return bounding_box_segment(img_rgb, output_path)
+        logger.debug("Background flood fill didn't work well, using bounding box approach")
+        return bounding_box_segment(img_rgb, output_path, details)
     
     # Find the largest contour (the leg)
     largest_contour = max(contours, key=cv2.contourArea)
@@ -296,11 +321,15 @@ def background_flood_fill(img, output_path=None):
     # Save if output path is provided
     if output_path:
         pil_image.save(output_path)
-        print(f"Processed image saved to {output_path}")
+        logger.info(f"Processed image saved to {output_path}")
+    
+    if details is not None:
+        details['method'] = 'background_fill'
+        details['mask'] = clean_mask
     
     return pil_image
 
-def bounding_box_segment(img_rgb, output_path=None):
+def bounding_box_segment(img_rgb, output_path=None, details=None):
     """Fallback method using bounding box approach"""
     # Convert to grayscale
     gray = cv2.cvtColor(cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR), cv2.COLOR_BGR2GRAY)
@@ -315,10 +344,13 @@ def bounding_box_segment(img_rgb, output_path=None):
     contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     
     if not contours:
-        print("No contours detected, returning original image")
+        logger.debug("No contours detected, returning original image")
         result = Image.fromarray(img_rgb)
         if output_path:
             result.save(output_path)
+        if details is not None:
+            details['method'] = 'none'
+            details['mask'] = np.full(img_rgb.shape[:2], 255, dtype=np.uint8)
         return result
     
     # Find the largest contour
@@ -343,7 +375,13 @@ def bounding_box_segment(img_rgb, output_path=None):
     # Save if output path is provided
     if output_path:
         pil_image.save(output_path)
-        print(f"Processed image saved to {output_path}")
+        logger.info(f"Processed image saved to {output_path}")
+    
+    if details is not None:
+        details['method'] = 'bounding_box'
+        # Mask of the cropped region in the coordinates of the input image
+        details['mask'] = np.zeros(img_rgb.shape[:2], dtype=np.uint8)
+        details['mask'][y:y+h, x:x+w] = 255
     
     return pil_image
 
@@ -353,10 +391,11 @@ def segment_and_save(input_path, output_path):
         segment_leg(input_path, output_path)
         return True
     except Exception as e:
-        print(f"Error processing image {input_path}: {e}")
+        logger.error(f"Error processing image {input_path}: {e}")
         return False
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     # Test the processing on a sample image
     test_img = "models/test_img.jpg"
     if os.path.exists(test_img):
@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+import torch.optim as optim
+from torch.utils.data import DataLoader
+
+from train import PackedDataset, pack_dataset, split_indices, get_packed_transforms, create_model, train_model
+
+# Hyperparameters tuned by the sweep. Each entry is (distribution, *arguments).
+SEARCH_SPACE = {
+    'lr': ('log_uniform', 1e-4, 1e-2),
+    'batch_size': ('choice', [16, 32, 64]),
+    'augment_strength': ('uniform', 0.0, 2.0),
+    'epochs': ('choice', [10, 20, 30])
+}
+
+def sample_config(trial_id, seed, search_space=SEARCH_SPACE):
+    """Draw one configuration. The same (trial_id, seed) always gives the same config."""
+    rng = np.random.RandomState(seed * 100003 + trial_id)
+    config = {}
+    for name, (kind, *params) in search_space.items():
+        if kind == 'log_uniform':
+            config[name] = float(np.exp(rng.uniform(np.log(params[0]), np.log(params[1]))))
+        elif kind == 'uniform':
+            config[name] = float(rng.uniform(params[0], params[1]))
+        elif kind == 'choice':
+            config[name] = params[0][rng.randint(len(params[0]))]
+        else:
+            raise ValueError(f"Unknown search space distribution '{kind}' for {name}")
+    return config
+
+def asha_rungs(min_epochs, max_epochs, eta):
+    """Epochs at which trials are compared: min_epochs * eta^k below max_epochs"""
+    rungs = []
+    epoch = min_epochs
+    while epoch < max_epochs:
+        rungs.append(epoch)
+        epoch *= eta
+    return rungs
+
+class ResultsStore:
+    """SQLite file holding every trial and its rung results, so sweeps can be resumed.
+
+    Worker processes open their own connection to the same file.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS trials (
+                    trial_id INTEGER PRIMARY KEY,
+                    config TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    best_val_acc REAL,
+                    epochs_run INTEGER,
+                    checkpoint TEXT,
+                    train_time_s REAL
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rung_results (
+                    trial_id INTEGER NOT NULL,
+                    rung INTEGER NOT NULL,
+                    val_acc REAL NOT NULL,
+                    PRIMARY KEY (trial_id, rung)
+                )""")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    def add_trial(self, trial_id, config):
+        """Register a trial unless it already exists; returns the stored config"""
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO trials (trial_id, config, status) VALUES (?, ?, 'pending')",
+                         (trial_id, json.dumps(config)))
+            row = conn.execute("SELECT config FROM trials WHERE trial_id = ?", (trial_id,)).fetchone()
+        return json.loads(row[0])
+
+    def unfinished_trials(self):
+        """Trials that are pending or were interrupted while running"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT trial_id, config FROM trials "
+                                "WHERE status IN ('pending', 'running') ORDER BY trial_id").fetchall()
+        return [(trial_id, json.loads(config)) for trial_id, config in rows]
+
+    def start_trial(self, trial_id):
+        # An interrupted trial restarts from scratch, so drop its old rung results
+        with self._connect() as conn:
+            conn.execute("DELETE FROM rung_results WHERE trial_id = ?", (trial_id,))
+            conn.execute("UPDATE trials SET status = 'running' WHERE trial_id = ?", (trial_id,))
+
+    def finish_trial(self, trial_id, status, best_val_acc, epochs_run, checkpoint, train_time_s):
+        with self._connect() as conn:
+            conn.execute("UPDATE trials SET status = ?, best_val_acc = ?, epochs_run = ?, "
+                         "checkpoint = ?, train_time_s = ? WHERE trial_id = ?",
+                         (status, best_val_acc, epochs_run, checkpoint, train_time_s, trial_id))
+
+    def report_rung(self, trial_id, rung, val_acc, eta):
+        """Record a rung result and decide whether the trial should stop.
+
+        Follows asynchronous successive halving: a trial continues only if it
+        is in the top 1/eta of all results recorded so far at this rung.
+        """
+        with self._connect() as conn:
+            others = [row[0] for row in conn.execute(
+                "SELECT val_acc FROM rung_results WHERE rung = ? AND trial_id != ?", (rung, trial_id))]
+            conn.execute("INSERT OR REPLACE INTO rung_results (trial_id, rung, val_acc) VALUES (?, ?, ?)",
+                         (trial_id, rung, val_acc))
+
+        if not others:
+            return False
+        cutoff = np.percentile(others + [val_acc], 100 * (1 - 1 / eta))
+        return val_acc < cutoff
+
+    def leaderboard(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT trial_id, config, status, best_val_acc, epochs_run, checkpoint "
+                                "FROM trials WHERE best_val_acc IS NOT NULL "
+                                "ORDER BY best_val_acc DESC").fetchall()
+        return [{
+            'trial_id': trial_id,
+            'config': json.loads(config),
+            'status': status,
+            'best_val_acc': best_val_acc,
+            'epochs_run': epochs_run,
+            'checkpoint': checkpoint
+        } for trial_id, config, status, best_val_acc, epochs_run, checkpoint in rows]
+
+def run_trial(trial_id, config, images, labels, train_indices, val_indices, settings, num_threads):
+    """Train one configuration, reporting to the store at every rung. Runs in a worker process."""
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(settings['seed'] + trial_id)
+    cpu = torch.device('cpu')
+    store = ResultsStore(settings['db_path'])
+    store.start_trial(trial_id)
+
+    train_transform, val_transform = get_packed_transforms(config['augment_strength'])
+    train_loader = DataLoader(PackedDataset(images, labels, train_indices, transform=train_transform),
+                              batch_size=config['batch_size'], shuffle=True, num_workers=0)
+    val_loader = DataLoader(PackedDataset(images, labels, val_indices, transform=val_transform),
+                            batch_size=config['batch_size'], shuffle=False, num_workers=0)
+
+    model = create_model(pretrained=True).to(cpu)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=config['lr'])
+
+    rungs = set(settings['rungs'])
+    state = {'epochs_run': 0, 'stopped': False}
+
+    def on_epoch(epoch, train_acc, val_acc):
+        state['epochs_run'] = epoch
+        if epoch in rungs and store.report_rung(trial_id, epoch, val_acc, settings['eta']):
+            state['stopped'] = True
+            return True
+        return False
+
+    checkpoint_path = os.path.join(settings['output_dir'], f'trial_{trial_id}.pth')
+    start = time.time()
+    best_acc = train_model(model, train_loader, val_loader, criterion, optimizer,
+                           num_epochs=config['epochs'], checkpoint_path=checkpoint_path,
+                           device=cpu, epoch_callback=on_epoch)
+    train_time = time.time() - start
+
+    status = 'stopped' if state['stopped'] else 'completed'
+    store.finish_trial(trial_id, status, best_acc, state['epochs_run'], checkpoint_path, train_time)
+    return trial_id, status, best_acc, state['epochs_run']
+
+def main():
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep with asynchronous successive halving')
+    parser.add_argument('--name', default='sweep', help='Sweep name; rerunning with the same name resumes it')
+    parser.add_argument('--data-dir', default='data/CVI-img-datasets-2/imagedata')
+    parser.add_argument('--output-dir', default='models/checkpoints/sweeps')
+    parser.add_argument('--packed-cache', default='models/checkpoints/packed_224.pt',
+                        help='Decoded dataset cache shared by all trials (empty string to disable)')
+    parser.add_argument('--trials', type=int, default=27)
+    parser.add_argument('--jobs', type=int, default=4, help='Trials trained concurrently')
+    parser.add_argument('--min-epochs', type=int, default=2, help='Epochs before the first early-stopping decision')
+    parser.add_argument('--eta', type=int, default=3, help='Keep the top 1/eta of trials at each rung')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    output_dir = os.path.join(args.output_dir, args.name)
+    os.makedirs(output_dir, exist_ok=True)
+    db_path = os.path.join(output_dir, 'results.db')
+    store = ResultsStore(db_path)
+
+    max_epochs = max(SEARCH_SPACE['epochs'][1])
+    settings = {
+        'db_path': db_path,
+        'output_dir': output_dir,
+        'rungs': asha_rungs(args.min_epochs, max_epochs, args.eta),
+        'eta': args.eta,
+        'seed': args.seed
+    }
+
+    # Configs already in the store win, so a resumed sweep keeps its trials
+    for trial_id in range(args.trials):
+        store.add_trial(trial_id, sample_config(trial_id, args.seed))
+    pending = store.unfinished_trials()
+    print(f"Sweep '{args.name}': {args.trials} trials, {len(pending)} left to run, "
+          f"rungs at epochs {settings['rungs']}")
+
+    if pending:
+        images, labels = pack_dataset(args.data_dir, cache_path=args.packed_cache or None)
+        # The manifest's fixed stratified split, so every trial is scored on the same images
+        train_indices = split_indices(args.data_dir, 'train')
+        val_indices = split_indices(args.data_dir, 'val')
+        create_model(pretrained=True)  # Download the pretrained weights once
+
+        jobs = min(args.jobs, len(pending))
+        num_threads = max(1, (os.cpu_count() or 1) // jobs)
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=mp.get_context('spawn')) as executor:
+            futures = [
+                executor.submit(run_trial, trial_id, config, images, labels,
+                                train_indices, val_indices, settings, num_threads)
+                for trial_id, config in pending
+            ]
+            for future in as_completed(futures):
+                trial_id, status, best_acc, epochs_run = future.result()
+                print(f"Trial {trial_id} {status} after {epochs_run} epochs, best Val Acc {best_acc:.2f}%")
+
+    leaderboard = store.leaderboard()
+    if not leaderboard:
+        print("No finished trials")
+        return
+
+    total_epochs = sum(trial['epochs_run'] for trial in leaderboard)
+    full_epochs = sum(trial['config']['epochs'] for trial in leaderboard)
+    print(f"\nTrained {total_epochs} epochs in total, {full_epochs} without early stopping")
+    print("Top trials:")
+    for trial in leaderboard[:5]:
+        print(f"  Trial {trial['trial_id']}: {trial['best_val_acc']:.2f}% ({trial['status']}, "
+              f"{trial['epochs_run']} epochs) {trial['config']}")
+
+    best = leaderboard[0]
+    best_checkpoint = os.path.join(output_dir, 'best_model.pth')
+    shutil.copyfile(best['checkpoint'], best_checkpoint)
+    with open(os.path.join(output_dir, 'leaderboard.json'), 'w') as f:
+        json.dump(leaderboard, f, indent=2)
+    print(f"Best config {best['config']} saved to {best_checkpoint}")
+
+if __name__ == '__main__':
+    main()
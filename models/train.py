@@ -1,46 +1,47 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torchvision import models, transforms
+from torchvision import transforms
 from torch.utils.data import Dataset, DataLoader
 from PIL import Image
 import os
 from tqdm import tqdm
 import matplotlib.pyplot as plt
+from collections import Counter
+from architecture import DEFAULT_DESCRIPTOR, build_model
+from manifest import DatasetManifest, ClusterSampler
+
+# Mapping from grade folder to class index
+CLASS_MAPPING = {
+    '1': 0,  # normal (C0)
+    '2': 1,  # moderate (C1, C2,)
+    '3': 1,  # moderate (C2, C3)
+    '4': 2,  # severe (C4)
+    '5': 2   # severe (C5, C6)
+}
 
 # Check for MPS availability
 device = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
 
 class CVIDataset(Dataset):
-    def __init__(self, data_dir, transform=None):
+    def __init__(self, data_dir, transform=None, split=None):
         self.data_dir = data_dir
         self.transform = transform
         self.classes = ['normal', 'moderate', 'severe']
-        self.class_mapping = {
-            '1': 0,  # normal (C0)
-            '2': 1,  # moderate (C1, C2,)
-            '3': 1,  # moderate (C2, C3)
-            '4': 2,  # severe (C4)
-            '5': 2   # severe (C5, C6)
-        }
-        
-        self.images = []
-        self.labels = []
+        self.class_mapping = CLASS_MAPPING
         
-        # Load images and labels
-        for class_folder in os.listdir(data_dir):
-            if class_folder in self.class_mapping and class_folder.isdigit():
-                class_dir = os.path.join(data_dir, class_folder)
-                if os.path.isdir(class_dir):
-                    for img_name in os.listdir(class_dir):
-                        if img_name.endswith('.bmp'):
-                            self.images.append(os.path.join(class_dir, img_name))
-                            self.labels.append(self.class_mapping[class_folder])
+        # Load images and labels from the dataset manifest (refreshed incrementally)
+        # instead of walking the directory tree
+        manifest = DatasetManifest(data_dir)
+        manifest.update()
+        view = manifest.dataset(split, self.class_mapping)
+        self.images = view.images
+        self.labels = view.labels
         
         print(f"Found {len(self.images)} images across {len(self.classes)} classes")
+        class_counts = Counter(self.labels)
         for i, class_name in enumerate(self.classes):
-            class_count = sum(1 for label in self.labels if label == i)
-            print(f"Class {class_name}: {class_count} images")
+            print(f"Class {class_name}: {class_counts[i]} images")
     
     def __len__(self):
         return len(self.images)
@@ -55,7 +56,116 @@ class CVIDataset(Dataset):
             
         return image, label
 
-def train_model(model, train_loader, val_loader, criterion, optimizer, num_epochs=20):
+class PackedDataset(Dataset):
+    """View over images that were decoded once by pack_dataset().
+
+    Several views (e.g. the folds of a cross-validation run) can share the same
+    uint8 image tensor, so the .bmp files are only read and resized once.
+    """
+    def __init__(self, images, labels, indices=None, transform=None):
+        self.images = images
+        self.labels = labels
+        self.indices = list(range(len(labels))) if indices is None else list(indices)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        i = self.indices[idx]
+        image = self.images[i]
+        if self.transform:
+            image = self.transform(image)
+
+        return image, int(self.labels[i])
+
+def pack_dataset(data_dir, size=224, cache_path=None, num_workers=4):
+    """Decode and resize every image of a CVIDataset into one uint8 tensor.
+
+    Args:
+        data_dir: Dataset root passed to CVIDataset
+        size: Side length the images are resized to
+        cache_path: Optional .pt file; reused if it matches the manifest, written otherwise
+        num_workers: DataLoader workers used for decoding
+
+    Returns:
+        (images, labels) where images is an N x 3 x size x size uint8 tensor in
+        shared memory and labels is an N int64 tensor
+    """
+    dataset = CVIDataset(data_dir, transform=transforms.Compose([
+        transforms.Resize((size, size)),
+        transforms.PILToTensor()
+    ]))
+    
+    # Reuse the cache only if it holds exactly the images currently in the manifest
+    if cache_path and os.path.exists(cache_path):
+        packed = torch.load(cache_path)
+        if packed['size'] == size and packed.get('paths') == dataset.images:
+            print(f"Loaded packed dataset from {cache_path}")
+            return packed['images'].share_memory_(), packed['labels'].share_memory_()
+
+    images = torch.empty((len(dataset), 3, size, size), dtype=torch.uint8)
+    labels = torch.tensor(dataset.labels, dtype=torch.int64)
+
+    loader = DataLoader(dataset, batch_size=64, shuffle=False, num_workers=num_workers)
+    offset = 0
+    for batch, _ in tqdm(loader, desc='Packing dataset'):
+        images[offset:offset + len(batch)] = batch
+        offset += len(batch)
+
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        torch.save({'size': size, 'paths': dataset.images, 'images': images, 'labels': labels}, cache_path)
+        print(f"Packed dataset saved to {cache_path}")
+
+    return images.share_memory_(), labels.share_memory_()
+
+def pack_entries(data_dir):
+    """Manifest entries in the order of CVIDataset(data_dir) and pack_dataset(data_dir)"""
+    manifest = DatasetManifest(data_dir)
+    manifest.update()
+    return [entry for entry in manifest.select() if entry['grade'] in CLASS_MAPPING]
+
+def split_indices(data_dir, split):
+    """Positions of the images of a manifest split ('train', 'val', 'test') in
+    CVIDataset(data_dir) and pack_dataset(data_dir)"""
+    return [i for i, entry in enumerate(pack_entries(data_dir)) if entry['split'] == split]
+
+def get_packed_transforms(augment_strength=1.0):
+    """Train/val transforms for PackedDataset (uint8 tensors, already resized).
+
+    augment_strength=1.0 matches the augmentation used in main().
+    """
+    train_transform = transforms.Compose([
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomRotation(10 * augment_strength),
+        transforms.ColorJitter(brightness=0.2 * augment_strength, contrast=0.2 * augment_strength),
+        transforms.ConvertImageDtype(torch.float),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+    val_transform = transforms.Compose([
+        transforms.ConvertImageDtype(torch.float),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+    return train_transform, val_transform
+
+def create_model(pretrained=True, descriptor=DEFAULT_DESCRIPTOR):
+    """MobileNetV2 (or the architecture in descriptor) with a 3-class classifier head"""
+    return build_model(descriptor, pretrained=pretrained)
+
+def train_model(model, train_loader, val_loader, criterion, optimizer, num_epochs=20,
+                checkpoint_path='models/checkpoints/best_model.pth', device=device,
+                epoch_callback=None):
+    """Train with per-epoch validation, saving the best model to checkpoint_path.
+
+    epoch_callback(epoch, train_acc, val_acc) is called after every epoch
+    (epoch counts from 1); returning True stops training early.
+
+    Returns:
+        Best validation accuracy in percent
+    """
     best_acc = 0.0
     
     for epoch in range(num_epochs):
@@ -115,8 +225,14 @@ def train_model(model, train_loader, val_loader, criterion, optimizer, num_epoch
         # Save best model based on validation accuracy
         if val_acc > best_acc:
             best_acc = val_acc
-            torch.save(model.state_dict(), 'models/checkpoints/best_model.pth')
+            torch.save(model.state_dict(), checkpoint_path)
             print(f'New best model saved with validation accuracy: {best_acc:.2f}%')
+        
+        if epoch_callback and epoch_callback(epoch + 1, train_acc, val_acc):
+            print(f'Stopping early after epoch {epoch+1}')
+            break
+    
+    return best_acc
 
 def main():
     # Data transforms
@@ -135,26 +251,29 @@ def main():
         transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
     ])
     
-    # Create dataset
-    full_dataset = CVIDataset('data/CVI-img-datasets-2/imagedata', transform=train_transform)
-    
-    # Split dataset into train and validation sets
-    train_size = int(0.8 * len(full_dataset))
-    val_size = len(full_dataset) - train_size
-    train_dataset, val_dataset = torch.utils.data.random_split(full_dataset, [train_size, val_size])
-    
-    # Update transform for validation dataset
-    val_dataset.dataset.transform = val_transform
+    # Create train and validation views of the dataset manifest. Each view has
+    # its own transform, so training keeps its augmentation.
+    manifest = DatasetManifest('data/CVI-img-datasets-2/imagedata')
+    manifest.update()
+    train_dataset = manifest.dataset('train', CLASS_MAPPING, transform=train_transform)
+    val_dataset = manifest.dataset('val', CLASS_MAPPING, transform=val_transform)
+    train_size = len(train_dataset)
+    val_size = len(val_dataset)
     
-    # Create dataloaders
-    train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True, num_workers=4)
+    # Create dataloaders. Once models/dedupe.py has grouped near-duplicates,
+    # each epoch trains on one shot per cluster.
+    if len(set(train_dataset.groups)) < train_size:
+        sampler = ClusterSampler(train_dataset.groups)
+        train_loader = DataLoader(train_dataset, batch_size=32, sampler=sampler, num_workers=4)
+        print(f"Sampling one of each near-duplicate cluster: {len(sampler)} samples per epoch")
+    else:
+        train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True, num_workers=4)
     val_loader = DataLoader(val_dataset, batch_size=32, shuffle=False, num_workers=4)
     
     print(f"Training on {train_size} samples, validating on {val_size} samples")
     
     # Load pretrained MobileNetV2
-    model = models.mobilenet_v2(pretrained=True)
-    model.classifier[1] = nn.Linear(model.last_channel, 3)  # 3 classes
+    model = create_model(pretrained=True)
     model = model.to(device)
     
     # Loss and optimizer
@@ -10,6 +10,8 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 # from dataset import CVIDataset
 from segment_leg import segment_leg  # Import the segmentation function
+from manifest import DatasetManifest
+from collections import Counter
 
 # Set random seed for reproducibility
 random.seed(42)
@@ -23,7 +25,7 @@ device = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
 print(f"Using device: {device}")
 
 class CVIDataset(Dataset):
-    def __init__(self, data_dir, transform=None):
+    def __init__(self, data_dir, transform=None, split=None):
         self.data_dir = data_dir
         self.transform = transform
         self.classes = ['normal', 'moderate', 'severe']
@@ -35,26 +37,19 @@ class CVIDataset(Dataset):
             '5': 2   # severe (C5, C6)
         }
         
-        self.images = []
-        self.labels = []
-        self.image_paths = []  # Store original paths for visualization
-        
-        # Load images and labels
-        for class_folder in os.listdir(data_dir):
-            if class_folder in self.class_mapping and class_folder.isdigit():
-                class_dir = os.path.join(data_dir, class_folder)
-                if os.path.isdir(class_dir):
-                    for img_name in os.listdir(class_dir):
-                        if img_name.endswith('.bmp'):
-                            img_path = os.path.join(class_dir, img_name)
-                            self.images.append(img_path)
-                            self.labels.append(self.class_mapping[class_folder])
-                            self.image_paths.append(img_path)
+        # Load images and labels from the dataset manifest (refreshed incrementally)
+        # instead of walking the directory tree
+        manifest = DatasetManifest(data_dir)
+        manifest.update()
+        view = manifest.dataset(split, self.class_mapping)
+        self.images = view.images
+        self.labels = view.labels
+        self.image_paths = list(view.images)  # Store original paths for visualization
         
         print(f"Found {len(self.images)} images across {len(self.classes)} classes")
+        class_counts = Counter(self.labels)
         for i, class_name in enumerate(self.classes):
-            class_count = sum(1 for label in self.labels if label == i)
-            print(f"Class {class_name}: {class_count} images")
+            print(f"Class {class_name}: {class_counts[i]} images")
     
     def __len__(self):
         return len(self.images)